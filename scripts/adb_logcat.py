@@ -24,11 +24,35 @@
 import os
 import sys
 import re
+import stat
+import mmap
+import json
+import zlib
+import multiprocessing
 from io import StringIO
 import fcntl
 import termios
 import struct
 import getopt
+import signal
+import resource
+import threading
+import asyncio
+import heapq
+import bisect
+import subprocess
+import time
+import datetime
+import shlex
+import unicodedata
+from array import array
+from collections import namedtuple, OrderedDict, deque
+
+# Optional, for the batch filter of the files
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # unpack the current terminal width
 try:
@@ -40,6 +64,8 @@ except IOError:
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 
 LAST_USED = [RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE]
+TAG_COLORS = tuple(LAST_USED)
+# Fixed colors of some tags, the other tags get theirs from allocate_color()
 KNOWN_TAGS = {
     "dalvikvm": BLUE,
     "Process": BLUE,
@@ -48,270 +74,3200 @@ KNOWN_TAGS = {
 }
 
 
-def style_fmt(fgd=None, bgd=None, bright=False, dim=False, reset=False):
+def style_fmt(fgd=None, bgd=None, bright=False, dim=False, reset=False):
+    """
+    @brief
+
+    @param fgd
+    @param bgd
+    @param bright
+    @param dim
+    @param reset
+
+    @return
+    """
+    # manually derived from http://en.wikipedia.org/wiki/ANSI_escape_code#Codes
+    codes = []
+    if reset:
+        codes.append("0")
+    else:
+        if fgd is not None:
+            codes.append("3%d" % (fgd))
+        if bgd is not None:
+            if not bright:
+                codes.append("4%d" % (bgd))
+            else:
+                codes.append("10%d" % (bgd))
+        if dim:
+            codes.append("2")
+        else:
+            codes.append("22")
+    return "\033[%sm" % (";".join(codes))
+
+
+DEVICE_WIDTH = 14
+OWNER_WIDTH = 7
+THREAD_WIDTH = 7
+TIME_WIDTH = 20
+TAG_WIDTH = 26
+TAG_TYPE_WIDTH = 3
+
+# Every style the rendering can use, built once so that no escape sequence is
+# constructed while processing the lines
+STYLE_PALETTE = {
+    (fgd, bgd, dim): style_fmt(fgd=fgd, bgd=bgd, dim=dim)
+    for fgd in (None, *range(8))
+    for bgd in (None, *range(8))
+    for dim in (False, True)
+}
+RESET = style_fmt(reset=True)
+
+OWNER_STYLE = STYLE_PALETTE[(CYAN, BLACK, False)]
+THREAD_STYLE = STYLE_PALETTE[(CYAN, BLACK, False)]
+TIME_STYLE = STYLE_PALETTE[(GREEN, BLACK, False)]
+TAG_STYLES = [STYLE_PALETTE[(color, None, False)] for color in range(8)]
+EMPTY_TAG_TYPE_STYLE = STYLE_PALETTE[(None, BLACK, False)]
+BEGINNING_STYLE = STYLE_PALETTE[(WHITE, BLACK, False)]
+DEVICE_STYLES = [STYLE_PALETTE[(BLACK, color, False)] for color in range(8)]
+
+# Blank headers of the wrapped message parts, by header layout
+CONTINUATION_HEADERS = {}
+
+# Wrapping of the messages: distance between the tab stops of the terminal,
+# runs of printable ASCII characters (one column each) or single other
+# characters, and columns taken by each of the other characters met
+TAB_SIZE = 8
+rewrapsegment = re.compile(r"[ -~]+|[\s\S]")
+CHAR_WIDTHS = {}
+
+# Maximum number of tags remembered by the per tag caches
+TAG_CACHE_SIZE = 1024
+
+# Batched output: size of the pending lines triggering a write, and longest
+# time a line can stay pending (seconds)
+FLUSH_THRESHOLD = 64 * 1024
+FLUSH_INTERVAL = 0.05
+
+# Multiple devices mode: how long a line is held to be sorted with the lines of
+# the other devices (seconds), how often the held lines are checked, and the
+# most lines of a device held at once
+MERGE_DELAY = 0.25
+MERGE_TICK = 0.05
+DEVICE_BACKLOG = 1024
+
+# Lines read from adb ahead of the rendering, and what to do once they are
+# all taken: wait, drop the oldest line, or drop the lines below warning
+READ_BACKLOG = 16 * 1024
+OVERFLOW_POLICIES = ("block", "oldest", "level")
+DROP_LEVEL = "W"
+
+# --stats: the lines are counted in buckets of STATS_REFRESH seconds, the
+# table of the STATS_TOP busiest tags, levels and processes over the last
+# STATS_WINDOW buckets being printed at each new bucket
+STATS_REFRESH = 1.0
+STATS_WINDOW = 10
+STATS_TOP = 10
+
+# --profile: the functions timed as a stage of the line pipeline, in the order
+# of the report, the indented ones being part of the previous stage
+PROFILED_STAGES = ("read", "parse", "filter", "render", "  print_device",
+                   "  print_owner", "  print_thread", "  print_time",
+                   "  print_tag", "  print_tag_type", "  print_msg", "write",
+                   "  flush")
+
+# Size of the pieces of a file rendered by each process in parallel mode
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Pick the color of a new tag from a hash of its name instead of the least
+# recently used color, so that separate processes agree on it
+STABLE_COLORS = False
+
+TAG_TYPE_FORMAT = {
+    "V": STYLE_PALETTE[(WHITE, BLACK, False)],
+    "D": STYLE_PALETTE[(BLACK, BLUE, False)],
+    "I": STYLE_PALETTE[(BLACK, GREEN, False)],
+    "W": STYLE_PALETTE[(BLACK, YELLOW, False)],
+    "E": STYLE_PALETTE[(BLACK, RED, False)],
+    "F": STYLE_PALETTE[(RED, WHITE, False)],
+    "S": STYLE_PALETTE[(BLACK, CYAN, False)],
+}
+
+rebeginning = re.compile(r"^--------- beginning of ([^\)]+)([^\(]+)\r$")
+# The process id is the shortest text before the thread id: the greedy version
+# backtracked over the whole line and could end in the message
+rethreadtime = re.compile(r"^(\d+)-(\d+) (\d+):(\d+):(\d+).(\d+)([^\)]+?) "
+                          r"(\d+) ([VDIWEFS]) ([^\(]+?): (.*)$")
+retime = re.compile(r"^(\d+)-(\d+) (\d+):(\d+):(\d+).(\d+) "
+                    r"([VDIWEFS])/([^\(]+)\(([^\)]+)\): (.*)$")
+rethread = re.compile(r"^([VDIWEFS])\(([^\)]+):([^\)]+)\) (.*)$")
+rebrief = re.compile(r"^([VDIWEFS])/([^\(]+)\(([^\)]+)\): (.*)$")
+retag = re.compile(r"^([VDIWEFS])/([^\(]+?): (.*)$")
+
+BEGINNING_PREFIX = "--------- beginning of "
+
+# Fields extracted from a log line, None when absent from the format
+LogRecord = namedtuple("LogRecord",
+                       ["date", "owner", "thread", "tag_type", "tag", "msg"])
+
+# Regular expression of each handled format and how to map its groups on a
+# LogRecord
+LOGCAT_FORMATS = {
+    "threadtime": (rethreadtime,
+                   lambda g: LogRecord(g[:6], g[6], g[7], g[8], g[9], g[10])),
+    "thread": (rethread,
+               lambda g: LogRecord(None, g[1], g[2], g[0], None, g[3])),
+    "time": (retime,
+             lambda g: LogRecord(g[:6], g[8], None, g[6], g[7], g[9])),
+    "brief": (rebrief,
+              lambda g: LogRecord(None, g[2], None, g[0], g[1], g[3])),
+    "tag": (retag,
+            lambda g: LogRecord(None, None, None, g[0], g[1], g[2])),
+}
+
+# Order in which the formats are tried when a line does not match the current
+# one
+FORMAT_PRIORITY = ("threadtime", "thread", "time", "brief", "tag")
+
+# Bytes version of the format regular expressions, matched in place on a
+# memory mapped file between two offsets (hence the MULTILINE flag for ^)
+MAPPED_FORMATS = {
+    logcat_format: re.compile(regex.pattern.encode(), re.MULTILINE)
+    for logcat_format, (regex, _) in LOGCAT_FORMATS.items()
+}
+
+# Group numbers of the tag type, tag, message, owner and thread in each format
+# regular expression
+FORMAT_GROUPS = {
+    "threadtime": (9, 10, 11, 7, 8),
+    "thread": (1, None, 4, 2, 3),
+    "time": (7, 8, 10, 9, None),
+    "brief": (1, 2, 4, 3, None),
+    "tag": (1, 2, 3, None, None),
+}
+
+# Batch version of the mapped format regular expressions, for findall() on a
+# whole batch of lines: a line either matches the format or is captured as a
+# whole by an extra last group. The negated character classes must not run
+# over the end of the line.
+BATCH_FORMATS = {
+    logcat_format: re.compile(
+        b"^(?:" + regex.pattern[1:-1].replace(b"[^", b"[^\\n") + b")$|^(.*)$",
+        re.MULTILINE)
+    for logcat_format, regex in MAPPED_FORMATS.items()
+}
+
+# Size of the batches of lines of a file filtered together
+BATCH_SIZE = 1024 * 1024
+
+# Formats giving the date of the lines, in groups 1 to 6
+DATED_FORMATS = ("threadtime", "time")
+
+# --since/--until argument: [MM-DD ]HH:MM[:SS][.fff]
+retimearg = re.compile(r"^(?:(\d+)-(\d+) )?(\d+):(\d+)(?::(\d+))?"
+                       r"(?:\.(\d+))?$")
+
+# Below this size the time seek stops bisecting and reads the lines
+SEEK_WINDOW = 64 * 1024
+
+# Sidecar index of a log file, see build_index() and write_index()
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 2
+
+# "MM-DD HH:MM" key of the minutes of the index
+reindexminute = re.compile(rb"^(\d+)-(\d+) (\d+):(\d+)$")
+
+# Sections of the index holding posting lists, and whether their keys are
+# bytes (latin-1 text in the header of the index file) rather than ids
+INDEX_POSTINGS = {"tags": True, "levels": True, "pids": False, "tids": False,
+                  "minutes": True}
+
+# Priority of each tag type, as a str or as bytes
+LEVEL_PRIORITY = {"V": 2, "D": 3, "I": 4, "W": 5, "E": 6, "F": 7, "S": 8}
+LEVEL_PRIORITY.update({level.encode(): priority
+                       for level, priority in LEVEL_PRIORITY.items()})
+
+# Priority by character code of the tag type, for the numpy batch filter
+if numpy is not None:
+    LEVEL_CODES = numpy.zeros(256, numpy.int8)
+    for level, priority in LEVEL_PRIORITY.items():
+        if isinstance(level, str):
+            LEVEL_CODES[ord(level)] = priority
+
+# Binary logcat (-B): the fields of the logger_entry header common to every
+# version (payload length, header size, pid, tid, seconds, nanoseconds). The
+# version 1 header has no size field, 0 in its place, and is 20 bytes long.
+LOGGER_ENTRY = struct.Struct("<HHiiII")
+LOGGER_ENTRY_V1_SIZE = 20
+# Level of the binary entries by priority, the other priorities are the ones
+# of the event buffers which have no text
+BINARY_LEVELS = {priority: level for level, priority in LEVEL_PRIORITY.items()
+                 if isinstance(level, str)}
+# Size of the reads of binary logcat
+BINARY_CHUNK = 64 * 1024
+
+
+class LRUCache:
+    """
+    @brief Mapping bounded in size, evicting the least recently used entry.
+
+    Counts the hits and misses of the lookups.
+    """
+
+    def __init__(self, maxsize):
+        """
+        @brief
+
+        @param maxsize Maximum number of entries.
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """
+        @brief
+
+        @param key
+
+        @return Value of the key, None if it is not in the cache.
+        """
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        @brief
+
+        @param key
+        @param value
+        """
+        self._data[key] = value
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def stats(self):
+        """
+        @brief
+
+        @return Human readable hit/miss counters.
+        """
+        return "{} hits, {} misses, {}/{} entries".format(
+            self.hits, self.misses, len(self._data), self.maxsize)
+
+
+class BatchWriter:
+    """
+    @brief Gather the rendered lines and write them in large chunks.
+
+    The pending lines are written once they reach FLUSH_THRESHOLD characters,
+    or by a timer thread after FLUSH_INTERVAL so a slow stream still shows up
+    quickly. In line mode each line is written and flushed right away, for
+    the lowest latency when following a device. An error of a write of the
+    timer thread, such as a closed pipe, stops the timer and is raised by
+    the next write(), flush() or close() of the main thread.
+    """
+
+    def __init__(self, stream, line_mode=False):
+        """
+        @brief
+
+        @param stream File object to write to.
+        @param line_mode Write and flush each line on its own.
+        """
+        self.stream = stream
+        self.line_mode = line_mode
+        self._pending = []
+        self._pending_size = 0
+        self._closed = False
+        self._error = None
+        self._cond = threading.Condition()
+        self._thread = None
+        if not line_mode:
+            self._thread = threading.Thread(target=self._timer, daemon=True)
+            self._thread.start()
+
+    def write(self, text):
+        """
+        @brief
+
+        @param text
+        """
+        if self.line_mode:
+            self.stream.write(text)
+            self.stream.flush()
+            return
+
+        with self._cond:
+            self._raise_error()
+            if not self._pending:
+                self._cond.notify()
+            self._pending.append(text)
+            self._pending_size += len(text)
+            if self._pending_size >= FLUSH_THRESHOLD:
+                self._flush()
+
+    def _flush(self):
+        """
+        @brief Write the pending lines, the lock must be held.
+        """
+        if self._pending:
+            self.stream.write("".join(self._pending))
+            self.stream.flush()
+            self._pending = []
+            self._pending_size = 0
+
+    def _raise_error(self):
+        """
+        @brief Raise the error of the timer thread, if any, the lock must be
+               held.
+        """
+        if self._error is not None:
+            raise self._error
+
+    def _timer(self):
+        """
+        @brief Write the pending lines FLUSH_INTERVAL after the first one.
+        """
+        with self._cond:
+            while not self._closed:
+                if not self._pending:
+                    self._cond.wait()
+                    continue
+                self._cond.wait(FLUSH_INTERVAL)
+                try:
+                    self._flush()
+                except OSError as err:
+                    self._error = err
+                    return
+
+    def flush(self):
+        """
+        @brief
+        """
+        with self._cond:
+            self._raise_error()
+            self._flush()
+
+    def close(self):
+        """
+        @brief Write the pending lines and stop the timer.
+        """
+        try:
+            with self._cond:
+                self._closed = True
+                self._cond.notify()
+                self._raise_error()
+                self._flush()
+        finally:
+            if self._thread is not None:
+                self._thread.join()
+
+
+class LineRing:
+    """
+    @brief Read the lines of a stream from a thread, ahead of the rendering.
+
+    The lines wait in a ring of at most READ_BACKLOG lines, so a slow output
+    no longer stops the reading of adb and makes logd drop lines unseen. Once
+    the ring is full the overflow policy applies: "block" waits for room,
+    "oldest" drops the oldest line, "level" drops the new line when below
+    DROP_LEVEL and waits for room otherwise. The dropped lines are counted.
+    """
+
+    def __init__(self, stream, policy="block", size=READ_BACKLOG,
+                 logcat_format=None):
+        """
+        @brief
+
+        @param stream File object to read the lines from.
+        @param policy Overflow policy, one of OVERFLOW_POLICIES.
+        @param size Most lines waiting.
+        @param logcat_format Format of the lines, for the "level" policy.
+        """
+        self.stream = stream
+        self.policy = policy
+        self.size = size
+        self.dropped = 0
+        self._parser = LogcatParser(logcat_format)
+        self._lines = deque()
+        self._ended = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+        self._thread.start()
+
+    def _below_drop_level(self, line):
+        """
+        @brief
+        @param line
+        @return Whether the line has a level below DROP_LEVEL.
+        """
+        record = self._parser.parse(line)
+        return (record is not None
+                and LEVEL_PRIORITY[record.tag_type]
+                < LEVEL_PRIORITY[DROP_LEVEL])
+
+    def _reader(self):
+        """
+        @brief Move the lines of the stream to the ring, until its end.
+        """
+        while True:
+            line = self.stream.readline()
+            if not line:
+                break
+            with self._cond:
+                if len(self._lines) >= self.size:
+                    if self.policy == "oldest":
+                        self._lines.popleft()
+                        self.dropped += 1
+                    elif (self.policy == "level"
+                          and self._below_drop_level(line)):
+                        self.dropped += 1
+                        continue
+                    else:
+                        while len(self._lines) >= self.size:
+                            self._cond.wait()
+                self._lines.append(line)
+                self._cond.notify()
+        with self._cond:
+            self._ended = True
+            self._cond.notify()
+
+    def readline(self):
+        """
+        @brief
+        @return Next line, an empty string at the end of the stream.
+        """
+        with self._cond:
+            while not self._lines and not self._ended:
+                self._cond.wait()
+            if not self._lines:
+                return ""
+            line = self._lines.popleft()
+            self._cond.notify()
+            return line
+
+
+class LogcatParser:
+    """
+    @brief Parse log lines with the regular expression of a single format.
+
+    The format is either given at construction or detected on the first line.
+    When a line does not match the current format, the other ones are tried in
+    FORMAT_PRIORITY order and the first one matching becomes the current one,
+    so only one regular expression runs per line once the format is known.
+    """
+
+    def __init__(self, logcat_format=None):
+        """
+        @brief
+
+        @param logcat_format Expected format, None to detect it.
+        """
+        self.logcat_format = None
+        self._match = None
+        self._unpack = None
+        if logcat_format is not None:
+            self.select(logcat_format)
+
+    def select(self, logcat_format):
+        """
+        @brief Set the format expected for the next lines.
+
+        @param logcat_format
+        """
+        regex, self._unpack = LOGCAT_FORMATS[logcat_format]
+        self._match = regex.match
+        self.logcat_format = logcat_format
+
+    def parse(self, line):
+        """
+        @brief
+
+        @param line
+
+        @return LogRecord, None if the line is in none of the formats.
+        """
+        if self._match is not None:
+            match = self._match(line)
+            if match is not None:
+                return self._unpack(match.groups())
+
+        for logcat_format in FORMAT_PRIORITY:
+            if logcat_format == self.logcat_format:
+                continue
+            regex, unpack = LOGCAT_FORMATS[logcat_format]
+            match = regex.match(line)
+            if match is not None:
+                self.select(logcat_format)
+                return unpack(match.groups())
+        return None
+
+
+def date_key(date):
+    """
+    @brief
+
+    @param date Month, day, hours, minutes, seconds and fraction of second of a
+                line, str or bytes.
+
+    @return Tuple of ints ordering the dates, in milliseconds precision.
+    """
+    *fields, fraction = date
+    return (*map(int, fields), int(fraction) * 1000 // 10 ** len(fraction))
+
+
+def date_nanos(date):
+    """
+    @brief
+
+    @param date Month, day, hours, minutes, seconds and fraction of second of a
+                line, str.
+
+    @return Int ordering the dates, in nanoseconds precision, see key_nanos().
+    """
+    *fields, fraction = date
+    return (key_nanos((*map(int, fields), 0))
+            + int(fraction) * 10 ** (9 - len(fraction)))
+
+
+def key_nanos(key):
+    """
+    @brief
+
+    @param key Date key, see date_key().
+
+    @return Int of the date key, counting the nanoseconds from a 32 days
+            month 0, which orders the dates of a year and fits an int64.
+    """
+    month, day, hours, minutes, seconds, milliseconds = key
+    return (((((month * 32 + day) * 24 + hours) * 60 + minutes) * 60 + seconds)
+            * 1000 + milliseconds) * 1000000
+
+
+def parse_time(text):
+    """
+    @brief Parse the argument of --since/--until.
+
+    @param text [MM-DD ]HH:MM[:SS][.fff]
+
+    @return Date key with None as month and day when they are not given, None
+            if the text is not a time.
+    """
+    match = retimearg.match(text)
+    if match is None:
+        return None
+    month, day, hours, minutes, seconds, fraction = match.groups()
+    key = date_key((hours, minutes, seconds or "0", fraction or "0"))
+    if month is None:
+        return (None, None, *key)
+    return (int(month), int(day), *key)
+
+
+def parse_id(value):
+    """
+    @brief
+
+    @param value Process or thread id as parsed from the line, str or bytes.
+
+    @return The id as an int, None if there is none.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class LineFilter:
+    """
+    @brief Decide from the parsed fields of a line if it must be shown.
+
+    A line is shown when its level is at least the minimum level, its process
+    and thread are among the selected ones, its time is in the selected range,
+    and its tag matches the tag filter or its message matches the message
+    filter. The verdict of the tag filter is kept by tag name, in a bounded
+    cache, so the regular expression runs once per distinct tag. With the
+    KeywordMatcher of -K as message filter, the message is searched before
+    the tag and the pattern found is kept in pattern, to label the line
+    without searching it again.
+    """
+
+    def __init__(self, re_tag_filter=None, re_msg_filter=None,
+                 min_level=None, pids=None, tids=None, since=None,
+                 until=None):
+        """
+        @brief
+
+        @param re_tag_filter Compiled regular expression on the tag, or None.
+        @param re_msg_filter Compiled regular expression on the message, or
+                             None.
+        @param min_level Lowest priority shown (see LEVEL_PRIORITY), or None.
+        @param pids Set of the process ids shown, or None.
+        @param tids Set of the thread ids shown, or None.
+        @param since Date key (see date_key()) of the first lines shown, or
+                     None. Its month and day may be None, they are then
+                     the ones of the first dated line filtered.
+        @param until Date key of the last lines shown, or None, the same.
+        """
+        self.re_tag_filter = re_tag_filter
+        self.re_msg_filter = re_msg_filter
+        self.min_level = min_level
+        self.pids = pids
+        self.tids = tids
+        self.since = since
+        self.until = until
+        self.undated = any(key is not None and key[0] is None
+                           for key in (since, until))
+        self.tag_verdicts = LRUCache(TAG_CACHE_SIZE)
+        self.keywords = isinstance(re_msg_filter, KeywordMatcher)
+        self.pattern = None
+
+    def tag_match(self, tag):
+        """
+        @brief
+
+        @param tag
+
+        @return True if the tag matches the tag filter.
+        """
+        verdict = self.tag_verdicts.get(tag)
+        if verdict is None:
+            verdict = self.re_tag_filter.search(tag) is not None
+            self.tag_verdicts.put(tag, verdict)
+        return verdict
+
+    def msg_match(self, msg):
+        """
+        @brief
+
+        @param msg
+
+        @return True if the message matches the message filter.
+        """
+        found = self.re_msg_filter.search(msg)
+        if self.keywords:
+            self.pattern = found
+        return found is not None
+
+    def accept(self, record):
+        """
+        @brief
+
+        @param record LogRecord of the line.
+
+        @return True if the line must be shown.
+        """
+        if record.date is not None and not self.in_range(record.date):
+            return False
+        return self.accept_fields(record.tag_type, record.tag, record.msg,
+                                  record.owner, record.thread)
+
+    def in_range(self, date):
+        """
+        @brief
+
+        @param date Groups of the date of a line.
+
+        @return True if the date is in the selected time range.
+        """
+        if self.since is None and self.until is None:
+            return True
+        key = date_key(date)
+        if self.undated:
+            # A time without date is on the day of the first dated line
+            if self.since is not None and self.since[0] is None:
+                self.since = (*key[:2], *self.since[2:])
+            if self.until is not None and self.until[0] is None:
+                self.until = (*key[:2], *self.until[2:])
+            self.undated = False
+        return ((self.since is None or key >= self.since)
+                and (self.until is None or key <= self.until))
+
+    def accept_fields(self, tag_type, tag, msg, owner=None, thread=None):
+        """
+        @brief
+
+        @param tag_type
+        @param tag Tag, None if the format has none.
+        @param msg Message, only needed with a message filter.
+        @param owner Process id, only needed with a process filter.
+        @param thread Thread id, only needed with a thread filter.
+
+        @return True if the line must be shown.
+        """
+        if (self.min_level is not None
+                and LEVEL_PRIORITY.get(tag_type, 0) < self.min_level):
+            return False
+        if self.pids is not None and parse_id(owner) not in self.pids:
+            return False
+        if self.tids is not None and parse_id(thread) not in self.tids:
+            return False
+        if self.re_tag_filter is None and self.re_msg_filter is None:
+            return True
+        if self.keywords:
+            # The pattern found labels the line, even when its tag matches
+            self.pattern = None
+            if msg is not None and self.msg_match(msg):
+                return True
+            return (self.re_tag_filter is not None and tag is not None
+                    and self.tag_match(tag))
+        if (self.re_tag_filter is not None and tag is not None
+                and self.tag_match(tag)):
+            return True
+        return (self.re_msg_filter is not None and msg is not None
+                and self.msg_match(msg))
+
+
+class MappedLineFilter(LineFilter):
+    """
+    @brief LineFilter working on the bytes fields of a memory mapped file.
+
+    Tags are decoded once per distinct tag, on a miss of the verdict cache, and
+    messages only when there is a message filter.
+    """
+
+    def tag_match(self, tag):
+        """
+        @brief
+
+        @param tag Tag as bytes.
+
+        @return True if the tag matches the tag filter.
+        """
+        verdict = self.tag_verdicts.get(tag)
+        if verdict is None:
+            verdict = self.re_tag_filter.search(
+                tag.decode(errors="replace")) is not None
+            self.tag_verdicts.put(tag, verdict)
+        return verdict
+
+    def msg_match(self, msg):
+        """
+        @brief
+
+        @param msg Message as bytes.
+
+        @return True if the message matches the message filter.
+        """
+        found = self.re_msg_filter.search(msg.decode(errors="replace"))
+        if self.keywords:
+            self.pattern = found
+        return found is not None
+
+    def accept_match(self, match, groups):
+        """
+        @brief Only copies the groups of the match the filter needs.
+
+        @param match Match object of MappedLogcatParser.match().
+        @param groups Group numbers of the fields, see FORMAT_GROUPS.
+
+        @return True if the line must be shown.
+        """
+        type_group, tag_group, msg_group, owner_group, thread_group = groups
+        return self.accept_fields(
+            match.group(type_group),
+            match.group(tag_group) if tag_group else None,
+            match.group(msg_group) if self.re_msg_filter else None,
+            match.group(owner_group) if self.pids and owner_group else None,
+            match.group(thread_group) if self.tids and thread_group else None)
+
+
+def required_literal(expression):
+    """
+    @brief Find a literal text that every match of a regular expression
+           contains.
+
+    Only the plain characters outside of groups, classes and repetitions are
+    considered, so the literal found is certain but not always the longest
+    possible.
+
+    @param expression Regular expression.
+
+    @return The longest literal found, None if there is none.
+    """
+    # Inline flags may change what is required
+    if re.search(r"\(\?[aiLmsux]", expression):
+        return None
+
+    runs = []
+    run = []
+    index = 0
+    while index < len(expression):
+        char = expression[index]
+        index += 1
+        if char == "\\":
+            escaped = expression[index:index + 1]
+            index += 1
+            if escaped and not escaped.isalnum():
+                run.append(escaped)
+                continue
+        elif char == "[":
+            # Skip the class, a leading ] or ^] being part of it
+            if expression[index:index + 1] == "^":
+                index += 1
+            if expression[index:index + 1] == "]":
+                index += 1
+            while index < len(expression) and expression[index] != "]":
+                index += 2 if expression[index] == "\\" else 1
+            index += 1
+        elif char == "(":
+            depth = 1
+            while index < len(expression) and depth:
+                if expression[index] == "\\":
+                    index += 1
+                elif expression[index] == "(":
+                    depth += 1
+                elif expression[index] == ")":
+                    depth -= 1
+                index += 1
+        elif char in "*?{":
+            # The repeated character may be absent
+            if run:
+                run.pop()
+            if char == "{":
+                index = expression.find("}", index) + 1 or len(expression)
+        elif char == "|":
+            # Nothing is required by every alternative
+            return None
+        elif char not in ".^$+":
+            run.append(char)
+            continue
+        runs.append("".join(run))
+        run = []
+    runs.append("".join(run))
+    return max(runs, key=len) or None
+
+
+def trie_pattern(words):
+    """
+    @brief Build a regular expression matching any of some words, their common
+           prefixes factored in a trie so each position is checked in one pass.
+
+    @param words
+
+    @return Regular expression, matching the longest word at a position.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def branch(node):
+        alternatives = [re.escape(char) + branch(child)
+                        for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ""
+        if "" in node:
+            return "(?:{})?".format("|".join(alternatives))
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:{})".format("|".join(alternatives))
+
+    return branch(trie)
+
+
+def load_keywords(path):
+    """
+    @brief Read the patterns of a keyword file.
+
+    One pattern per line: "re:" followed by a regular expression, or a
+    literal text. The empty lines and the ones starting with # are skipped.
+
+    @param path
+
+    @return List of the patterns.
+    """
+    with open(path, errors="replace") as keywords:
+        return [line for line in keywords.read().splitlines()
+                if line and not line.startswith("#")]
+
+
+class KeywordMatcher:
+    """
+    @brief Search many literal keywords and regular expressions at once.
+
+    The literals, and the literal text each regular expression requires (see
+    required_literal()), are merged in a trie compiled to a single regular
+    expression, so a message is scanned once whatever the number of patterns,
+    like with an Aho-Corasick automaton. A regular expression only runs on the
+    messages where its required literal was found, or on every message when it
+    has none.
+
+    It has the search() of a compiled regular expression, so it is used as the
+    message filter of a LineFilter.
+    """
+
+    def __init__(self, patterns, flags=0):
+        """
+        @brief
+
+        @param patterns List of the patterns, see load_keywords().
+        @param flags Flags of the regular expressions, re.IGNORECASE applies
+                     to the literals too.
+
+        @exception re.error A regular expression of the patterns is invalid.
+        """
+        self.patterns = patterns
+        self._fold = bool(flags & re.IGNORECASE)
+        # Patterns to check when a word of the trie is found, and regular
+        # expressions to always run
+        triggers = {}
+        self._unanchored = []
+        for pattern in patterns:
+            if pattern.startswith("re:"):
+                regex = re.compile(pattern[3:], flags)
+                word = required_literal(pattern[3:])
+                if word is None:
+                    self._unanchored.append((pattern, regex))
+                    continue
+            else:
+                regex = None
+                word = pattern
+            if self._fold:
+                word = word.lower()
+            triggers.setdefault(word, []).append((pattern, regex))
+
+        # The trie matches the longest word at a position, the shorter ones
+        # found there are its prefixes
+        self._candidates = {
+            word: [candidate for length in range(1, len(word) + 1)
+                   for candidate in triggers.get(word[:length], ())]
+            for word in triggers
+        }
+        self._trie = None
+        if triggers:
+            self._trie = re.compile(trie_pattern(triggers), flags)
+
+    def search(self, text):
+        """
+        @brief
+
+        @param text
+
+        @return The first pattern found in the text, None if there is none.
+        """
+        if self._trie is not None:
+            failed = None
+            position = 0
+            while True:
+                match = self._trie.search(text, position)
+                if match is None:
+                    break
+                word = match.group()
+                for pattern, regex in self._candidates[
+                        word.lower() if self._fold else word]:
+                    if regex is None:
+                        return pattern
+                    if failed is None or pattern not in failed:
+                        if regex.search(text):
+                            return pattern
+                        failed = failed or set()
+                        failed.add(pattern)
+                position = match.start() + 1
+
+        for pattern, regex in self._unanchored:
+            if regex.search(text):
+                return pattern
+        return None
+
+
+class MappedLogcatParser:
+    """
+    @brief Match the lines of a memory mapped file in place.
+
+    Same format detection as LogcatParser, with the bytes regular expressions
+    of MAPPED_FORMATS matched directly on the mapping, so a line is only copied
+    once its fields are needed.
+    """
+
+    def __init__(self, mapping, logcat_format=None):
+        """
+        @brief
+
+        @param mapping mmap of the file.
+        @param logcat_format Expected format, None to detect it.
+        """
+        self.mapping = mapping
+        self.logcat_format = None
+        self.groups = None
+        self.unpack = None
+        self._match = None
+        if logcat_format is not None:
+            self.select(logcat_format)
+
+    def select(self, logcat_format):
+        """
+        @brief Set the format expected for the next lines.
+
+        @param logcat_format
+        """
+        self._match = MAPPED_FORMATS[logcat_format].match
+        self.unpack = LOGCAT_FORMATS[logcat_format][1]
+        self.groups = FORMAT_GROUPS[logcat_format]
+        self.logcat_format = logcat_format
+
+    def match(self, start, end):
+        """
+        @brief
+
+        @param start Offset of the line.
+        @param end Offset of the end of line, newline excluded.
+
+        @return Match object, None if the line is in none of the formats.
+        """
+        if self._match is not None:
+            match = self._match(self.mapping, start, end)
+            if match is not None:
+                return match
+
+        for logcat_format in FORMAT_PRIORITY:
+            if logcat_format == self.logcat_format:
+                continue
+            match = MAPPED_FORMATS[logcat_format].match(self.mapping, start,
+                                                        end)
+            if match is not None:
+                self.select(logcat_format)
+                return match
+        return None
+
+    def record(self, match):
+        """
+        @brief
+
+        @param match Match object returned by match().
+
+        @return LogRecord of the matched line.
+        """
+        return self.unpack(tuple(group.decode(errors="replace")
+                                 for group in match.groups()))
+
+
+class BinaryLogReader:
+    """
+    @brief Decode the logger entries of binary logcat (-B) from a stream.
+
+    The logger_entry headers are unpacked with struct, whatever their version,
+    and the payload is split in priority, tag and message, so no regular
+    expression runs. The time keeps its nanoseconds.
+    """
+
+    def __init__(self, stream):
+        """
+        @brief
+
+        @param stream Binary file object to read the entries from.
+        """
+        self.stream = stream
+        self._second = None
+        self._date = None
+
+    def date(self, sec, nsec):
+        """
+        @brief
+
+        @param sec Seconds since the epoch of an entry.
+        @param nsec Nanoseconds of the entry.
+
+        @return Month, day, hours, minutes, seconds and fraction of second of
+                the entry in local time, as strings like the parsed dates.
+        """
+        # The entries come in bursts, convert each second once
+        if sec != self._second:
+            tm = time.localtime(sec)
+            self._second = sec
+            self._date = (f"{tm.tm_mon:02}", f"{tm.tm_mday:02}",
+                          f"{tm.tm_hour:02}", f"{tm.tm_min:02}",
+                          f"{tm.tm_sec:02}")
+        return (*self._date, f"{nsec:09}")
+
+    def records(self):
+        """
+        @brief Read and decode the entries until the end of the stream.
+
+        @return Iterator on the LogRecord of the entries, one per line of
+                their message.
+        """
+        buf = bytearray()
+        start = 0
+        while True:
+            data = self.stream.read1(BINARY_CHUNK)
+            if not data:
+                break
+            del buf[:start]
+            buf += data
+            start = 0
+
+            while len(buf) - start >= LOGGER_ENTRY.size:
+                (length, header_size, pid, tid,
+                 sec, nsec) = LOGGER_ENTRY.unpack_from(buf, start)
+                payload = start + (header_size or LOGGER_ENTRY_V1_SIZE)
+                if payload + length > len(buf):
+                    break
+                start = payload + length
+
+                level = BINARY_LEVELS.get(buf[payload])
+                tag_end = buf.find(b"\0", payload + 1, start)
+                if level is None or tag_end < 0:
+                    continue
+                tag = buf[payload + 1:tag_end].decode(errors="replace")
+                msg_end = buf.find(b"\0", tag_end + 1, start)
+                if msg_end < 0:
+                    msg_end = start
+                msg = buf[tag_end + 1:msg_end].decode(errors="replace")
+
+                date = self.date(sec, nsec)
+                owner = str(pid)
+                thread = str(tid)
+                for line in msg.rstrip("\n").split("\n"):
+                    yield LogRecord(date, owner, thread, level, tag, line)
+
+
+class RecordStore:
+    """
+    @brief Parsed records of a session, kept in compact columns.
+
+    Every field is in an array of machine integers: the tag as the id of the
+    interned tag name, the level as a byte, the process and thread ids, the
+    time as an int64 of nanoseconds (see date_nanos()). The messages are
+    encoded in a single buffer, delimited by an array of offsets. A record
+    takes about 30 bytes plus its message, instead of the few hundreds of a
+    tuple of strings, and the columns are scanned without building records.
+    An absent field is stored as -1 (0 for the level).
+    """
+
+    def __init__(self):
+        """
+        @brief
+        """
+        self.tags = []
+        self.tag_ids = array("i")
+        self.levels = bytearray()
+        self.pids = array("i")
+        self.tids = array("i")
+        self.times = array("q")
+        self.messages = bytearray()
+        self.offsets = array("Q", [0])
+        # Digits of the fraction of second shown, 9 for binary logcat
+        self.fraction_digits = 3
+        self._tag_ids = {}
+
+    def __len__(self):
+        return len(self.levels)
+
+    def append(self, record):
+        """
+        @brief
+
+        @param record LogRecord to add.
+        """
+        date, owner, thread, tag_type, tag, msg = record
+        if tag is None:
+            tag_id = -1
+        else:
+            tag_id = self._tag_ids.get(tag)
+            if tag_id is None:
+                tag_id = self._tag_ids[tag] = len(self.tags)
+                self.tags.append(tag)
+        self.tag_ids.append(tag_id)
+        self.levels.append(LEVEL_PRIORITY.get(tag_type, 0))
+        pid = parse_id(owner)
+        self.pids.append(-1 if pid is None else pid)
+        tid = parse_id(thread)
+        self.tids.append(-1 if tid is None else tid)
+        if date is None:
+            self.times.append(-1)
+        else:
+            self.times.append(date_nanos(date))
+            if len(date[5]) > self.fraction_digits:
+                self.fraction_digits = len(date[5])
+        if msg is not None:
+            self.messages += msg.encode()
+        self.offsets.append(len(self.messages))
+
+    def message(self, index):
+        """
+        @brief
+
+        @param index
+
+        @return Message of the record.
+        """
+        return self.messages[self.offsets[index]:
+                             self.offsets[index + 1]].decode(errors="replace")
+
+    def date(self, index):
+        """
+        @brief
+
+        @param index
+
+        @return Date of the record as parsed, None if it has none.
+        """
+        nanos = self.times[index]
+        if nanos < 0:
+            return None
+        nanos, fraction = divmod(nanos, 10 ** 9)
+        nanos, seconds = divmod(nanos, 60)
+        nanos, minutes = divmod(nanos, 60)
+        nanos, hours = divmod(nanos, 24)
+        month, day = divmod(nanos, 32)
+        digits = self.fraction_digits
+        return (f"{month:02}", f"{day:02}", f"{hours:02}", f"{minutes:02}",
+                f"{seconds:02}", f"{fraction // 10 ** (9 - digits):0{digits}}")
+
+    def record(self, index):
+        """
+        @brief
+
+        @param index
+
+        @return LogRecord rebuilt from the columns.
+        """
+        tag_id = self.tag_ids[index]
+        pid = self.pids[index]
+        tid = self.tids[index]
+        level = self.levels[index]
+        return LogRecord(self.date(index),
+                         None if pid < 0 else str(pid),
+                         None if tid < 0 else str(tid),
+                         BINARY_LEVELS[level] if level else None,
+                         None if tag_id < 0 else self.tags[tag_id],
+                         self.message(index))
+
+    def matching(self, line_filter):
+        """
+        @brief Filter the records on their columns.
+
+        Same verdicts as LineFilter.accept(), the tag filter runs once per
+        interned tag and only the messages reaching the message filter are
+        decoded.
+
+        @param line_filter LineFilter to apply, or None.
+
+        @return Indexes of the records accepted.
+        """
+        if line_filter is None:
+            return range(len(self))
+
+        since = until = None
+        if line_filter.since is not None:
+            since = key_nanos(line_filter.since)
+        if line_filter.until is not None:
+            # Up to the end of the last millisecond
+            until = key_nanos(line_filter.until) + 999999
+        min_level = line_filter.min_level
+        pids = line_filter.pids
+        tids = line_filter.tids
+        re_msg_filter = line_filter.re_msg_filter
+        tag_verdicts = None
+        if line_filter.re_tag_filter is not None:
+            tag_verdicts = [line_filter.re_tag_filter.search(tag) is not None
+                            for tag in self.tags]
+        text_filter = tag_verdicts is not None or re_msg_filter is not None
+
+        times = self.times
+        levels = self.levels
+        tag_ids = self.tag_ids
+        selected = []
+        for index in range(len(self)):
+            nanos = times[index]
+            if nanos >= 0 and ((since is not None and nanos < since)
+                               or (until is not None and nanos > until)):
+                continue
+            if min_level is not None and levels[index] < min_level:
+                continue
+            if pids is not None and self.pids[index] not in pids:
+                continue
+            if tids is not None and self.tids[index] not in tids:
+                continue
+            if text_filter:
+                tag_id = tag_ids[index]
+                if not ((tag_verdicts is not None and tag_id >= 0
+                         and tag_verdicts[tag_id])
+                        or (re_msg_filter is not None
+                            and re_msg_filter.search(self.message(index)))):
+                    continue
+            selected.append(index)
+        return selected
+
+
+class ThroughputStats:
+    """
+    @brief Count the lines and bytes per tag, level and process over a sliding
+           window and print the busiest ones.
+
+    A line costs a single dict update, keyed by its tag, level and process
+    together, in the bucket of the current STATS_REFRESH seconds. A timer
+    thread starts a new bucket every STATS_REFRESH seconds, moves the buckets
+    older than the window to the totals, and only then sums the window by
+    tag, by level and by process for the table.
+    """
+
+    # Sections of the table: title and index in the key of the counters
+    SECTIONS = (("Tag", 0), ("Level", 1), ("PID", 2))
+
+    def __init__(self, stream, ring=None, top=STATS_TOP, window=STATS_WINDOW):
+        """
+        @brief
+
+        @param stream File object the tables are printed to.
+        @param ring LineRing the lines are read from, for its dropped lines,
+                    or None.
+        @param top Most entries in each section of the table.
+        @param window Buckets in the sliding window.
+        """
+        self.stream = stream
+        self.ring = ring
+        self.top = top
+        self.window = window
+        self._clear = stream.isatty()
+        self._started = time.monotonic()
+        self._bucket_start = self._started
+        self._bucket = {}
+        self._buckets = deque()
+        self._totals = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._timer, daemon=True)
+        self._thread.start()
+
+    def add(self, record, size):
+        """
+        @brief Count a line.
+
+        @param record LogRecord of the line, None if it is in no format.
+        @param size Length of the line.
+        """
+        key = (None, None, None) if record is None else (
+            record.tag, record.tag_type, record.owner)
+        with self._cond:
+            counts = self._bucket.get(key)
+            if counts is None:
+                self._bucket[key] = [1, size]
+            else:
+                counts[0] += 1
+                counts[1] += size
+
+    @staticmethod
+    def _merge(counters, bucket, field=None):
+        """
+        @brief Add the counts of a bucket to other ones.
+
+        @param counters Dict of [lines, bytes] to add to.
+        @param bucket Dict of [lines, bytes] by key to add.
+        @param field Index in the key of the bucket of the key of the
+                     counters, None for the whole key.
+        """
+        for key, (lines, size) in bucket.items():
+            if field is not None:
+                key = key[field]
+            counts = counters.get(key)
+            if counts is None:
+                counters[key] = [lines, size]
+            else:
+                counts[0] += lines
+                counts[1] += size
+
+    def _rotate(self):
+        """
+        @brief Start a new bucket, the lock must be held.
+        """
+        self._buckets.append((self._bucket_start, self._bucket))
+        self._bucket_start = time.monotonic()
+        self._bucket = {}
+        while len(self._buckets) > self.window:
+            _, bucket = self._buckets.popleft()
+            self._merge(self._totals, bucket)
+
+    def table(self, total=False):
+        """
+        @brief Format the busiest entries, the lock must be held.
+
+        @param total Count the whole input instead of the window.
+
+        @return Text of the table.
+        """
+        counters = {}
+        if total:
+            self._merge(counters, self._totals)
+            start = self._started
+        else:
+            start = self._buckets[0][0]
+        for _, bucket in self._buckets:
+            self._merge(counters, bucket)
+        span = max(self._bucket_start - start, 1e-3)
+        lines = sum(counts[0] for counts in counters.values())
+        size = sum(counts[1] for counts in counters.values())
+
+        text = StringIO()
+        if self._clear:
+            text.write("\x1b[H\x1b[2J")
+        text.write("{} {:.1f} s: {} lines, {:.0f} lines/s, {:.0f} bytes/s"
+                   .format("Over all" if total else "Over the last", span,
+                           lines,
+                           lines / span, size / span))
+        if self.ring is not None:
+            text.write(f", {self.ring.dropped} dropped")
+        text.write("\n")
+
+        for title, field in self.SECTIONS:
+            sums = {}
+            self._merge(sums, counters, field)
+            busiest = sorted(sums.items(), key=lambda item: -item[1][0])
+            text.write("\n{:<{}} {:>10} {:>12} {:>6}\n".format(
+                title, TAG_WIDTH, "lines/s", "bytes/s", "share"))
+            for name, (key_lines, key_size) in busiest[:self.top]:
+                if name is None:
+                    name = "(no format)" if field == 0 else "-"
+                text.write("{:<{}} {:>10.1f} {:>12.0f} {:>5.1f}%\n".format(
+                    name.strip()[:TAG_WIDTH], TAG_WIDTH, key_lines / span,
+                    key_size / span, 100 * key_lines / lines))
+        return text.getvalue()
+
+    def _timer(self):
+        """
+        @brief Start a bucket and print the table every STATS_REFRESH.
+        """
+        with self._cond:
+            while True:
+                self._cond.wait(STATS_REFRESH)
+                if self._closed:
+                    break
+                self._rotate()
+                self.stream.write(self.table())
+                self.stream.flush()
+
+    def close(self):
+        """
+        @brief Stop the timer and print the table of the whole input.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._rotate()
+        self.stream.write(self.table(total=True))
+        self.stream.flush()
+
+
+class StageProfiler:
+    """
+    @brief Cumulative time and calls of each stage of the line pipeline.
+
+    The stages are timed by wrapping the functions doing them with
+    perf_counter() calls, so nothing is added when not profiling. The reading
+    also counts the lines and bytes of the input.
+    """
+
+    def __init__(self):
+        """
+        @brief
+        """
+        self.stages = {stage.strip(): [0, 0.0] for stage in PROFILED_STAGES}
+        self.lines = 0
+        self.bytes = 0
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def timed(self, stage, func, threaded=False):
+        """
+        @brief
+
+        @param stage Name of the stage, in PROFILED_STAGES.
+        @param func Function doing the stage.
+        @param threaded Whether func is also called from other threads, the
+                        counters of the stage are then updated under a lock.
+
+        @return Function calling func and adding its time to the stage.
+        """
+        counters = self.stages[stage]
+        clock = time.perf_counter
+
+        def timed_func(*args, **kwargs):
+            start = clock()
+            result = func(*args, **kwargs)
+            counters[0] += 1
+            counters[1] += clock() - start
+            return result
+
+        def locked_func(*args, **kwargs):
+            start = clock()
+            result = func(*args, **kwargs)
+            elapsed = clock() - start
+            with self._lock:
+                counters[0] += 1
+                counters[1] += elapsed
+            return result
+        return locked_func if threaded else timed_func
+
+    def reader(self, readline):
+        """
+        @brief
+
+        @param readline Function returning the next line of the input.
+
+        @return Function calling readline, timed as the read stage, and
+                counting the lines and bytes read.
+        """
+        readline = self.timed("read", readline)
+
+        def counted_readline():
+            line = readline()
+            if line:
+                self.lines += 1
+                self.bytes += len(line)
+            return line
+        return counted_readline
+
+    def records(self, records):
+        """
+        @brief
+
+        @param records Iterator on the LogRecord of binary logcat.
+
+        @return Iterator on the same records, their decoding timed as the
+                read stage and counted as lines.
+        """
+        counters = self.stages["read"]
+        clock = time.perf_counter
+        records = iter(records)
+        while True:
+            start = clock()
+            record = next(records, None)
+            counters[0] += 1
+            counters[1] += clock() - start
+            if record is None:
+                break
+            self.lines += 1
+            self.bytes += len(record.tag) + len(record.msg)
+            yield record
+
+    def install(self, parser, line_filter, writers):
+        """
+        @brief Time the stages of the rendering of the lines.
+
+        @param parser LogcatParser of the lines.
+        @param line_filter LineFilter of the lines, or None.
+        @param writers BatchWriter of the outputs.
+        """
+        parser.parse = self.timed("parse", parser.parse)
+        if line_filter is not None:
+            line_filter.accept = self.timed("filter", line_filter.accept)
+        for writer in writers:
+            writer.write = self.timed("write", writer.write)
+            # Also called by the timer threads of the writers
+            writer._flush = self.timed("flush", writer._flush, threaded=True)
+
+        # The rendering functions are looked up in the module on each call
+        module = globals()
+        for name in ("render_record", "render_unparsed"):
+            module[name] = self.timed("render", module[name])
+        for stage in PROFILED_STAGES:
+            if stage.startswith("  print_"):
+                module[stage.strip()] = self.timed(stage.strip(),
+                                                   module[stage.strip()])
+
+    def report(self):
+        """
+        @brief
+        @return Text of the time of each stage, the rates of the input and
+                the peak memory use.
+        """
+        elapsed = max(time.perf_counter() - self._started, 1e-6)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        text = StringIO()
+        text.write("Profile of {:.3f} s: {} lines, {:.0f} lines/s, "
+                   "{:.0f} bytes/s, peak RSS {:.1f} MiB\n".format(
+                       elapsed, self.lines, self.lines / elapsed,
+                       self.bytes / elapsed, peak / 1024))
+        text.write("{:<18} {:>10} {:>10} {:>10} {:>6}\n".format(
+            "stage", "calls", "total s", "us/call", "share"))
+        for stage in PROFILED_STAGES:
+            calls, seconds = self.stages[stage.strip()]
+            if not calls:
+                continue
+            text.write("{:<18} {:>10} {:>10.3f} {:>10.2f} {:>5.1f}%\n".format(
+                stage, calls, seconds, 1e6 * seconds / calls,
+                100 * seconds / elapsed))
+        return text.getvalue()
+
+
+def print_owner(linebuf, colorless, owner):
+    """
+    @brief
+
+    @param linebuf
+    @param colorless
+    @param owner
+
+    @return
+    """
+    # center process owner info
+    owner = owner.strip().center(OWNER_WIDTH)
+    linebuf.write(
+        "{}{}{}".format(
+            OWNER_STYLE,
+            owner,
+            RESET
+        )
+    )
+    colorless.write(f'{owner}')
+    return OWNER_WIDTH
+
+
+def print_thread(linebuf, colorless, thread):
+    """
+    @brief
+
+    @param linebuf
+    @param colorless
+    @param thread
+
+    @return
+    """
+    # center thread info
+    thread = thread.strip().center(THREAD_WIDTH)
+    linebuf.write(
+        "{}{}{}".format(
+            THREAD_STYLE,
+            thread,
+            RESET
+        )
+    )
+    colorless.write(f'{thread}')
+    return THREAD_WIDTH
+
+
+def print_time(linebuf, colorless, date):
+    """
+    @brief
+
+    @param linebuf
+    @param colorless
+    @param m
+    @param d
+    @param h
+    @param mi
+    @param s
+    @param ms
+
+    @return
+    """
+    linebuf.write(
+        "{} {}-{} {}:{}:{}.{} {}".format(
+            TIME_STYLE,
+            *date,
+            RESET
+        )
+    )
+    colorless.write(
+        " {}-{} {}:{}:{}.{} ".format(
+            *date
+        )
+    )
+    # Milliseconds in the text formats, nanoseconds in the binary one
+    return TIME_WIDTH + len(date[5]) - 3
+
+
+def allocate_color(tag):
+    """
+    @brief
+
+    @param tag
+
+    @return
+    """
+    # this will allocate a unique format for the given tag
+    # since we don't have very many colors, we always keep track of the LRU
+    # The color is kept with the title of the tag in the bounded TAG_CACHE,
+    # see tag_style(), a tag evicted from it gets a new color when it comes
+    # back
+    color = KNOWN_TAGS.get(tag)
+    if color is None:
+        if STABLE_COLORS:
+            color = TAG_COLORS[zlib.crc32(tag.encode()) % len(TAG_COLORS)]
+        else:
+            color = LAST_USED[0]
+    use_color(color)
+    return color
+
+
+def use_color(color):
+    """
+    @brief Mark a color as the most recently used one.
+
+    @param color
+    """
+    LAST_USED.remove(color)
+    LAST_USED.append(color)
+
+
+def tag_style(tag):
+    """
+    @brief Get the color and the right-aligned title of a tag.
+
+    Both are kept in the bounded TAG_CACHE so a known tag costs one lookup.
+
+    @param tag Tag as parsed from the line.
+
+    @return Tuple (color, title).
+    """
+    style = TAG_CACHE.get(tag)
+    if style is None:
+        title = tag.strip()
+        style = (allocate_color(title),
+                 title[-(TAG_WIDTH - 1):].rjust((TAG_WIDTH - 1)))
+        TAG_CACHE.put(tag, style)
+    else:
+        use_color(style[0])
+    return style
+
+
+def print_tag(linebuf, colorless, tag, color):
+    """
+    @brief
+
+    @param linebuf
+    @param colorless
+    @param tag Right-aligned tag title, see tag_style().
+    @param color Color allocated to the tag.
+
+    @return
+    """
+    linebuf.write(
+        "{}{} {}".format(
+            TAG_STYLES[color],
+            tag,
+            RESET
+        )
+    )
+    colorless.write(f'{tag} ')
+    return TAG_WIDTH
+
+
+TAG_CACHE = LRUCache(TAG_CACHE_SIZE)
+
+
+def print_tag_type(linebuf, colorless, tag_type):
+    """
+    @brief
+
+    @param linebuf
+    @param colorless
+    @param tag_type
+
+    @return
+    """
+    linebuf.write(
+        "{}{}{} ".format(
+            TAG_TYPE_FORMAT[tag_type],
+            tag_type.center(TAG_TYPE_WIDTH),
+            RESET
+        )
+    )
+    colorless.write("{} ".format(tag_type.center(TAG_TYPE_WIDTH)))
+    return TAG_TYPE_WIDTH + 1
+
+
+def continuation_header(layout):
+    """
+    @brief Get the colored blank header put in front of the wrapped parts of a
+           message.
+
+    The headers are only built when a message actually wraps, once per layout.
+
+    @param layout Tuple of the color of the device (None without device),
+                  telling if the owner, thread fields are present, the width
+                  of the time field (0 without time), the color of the tag
+                  (None without tag) and telling if the tag type is present.
+
+    @return
+    """
+    header = CONTINUATION_HEADERS.get(layout)
+    if header is None:
+        (device_color, has_owner, has_thread, time_width, tag_color,
+         has_tag_type) = layout
+        parts = []
+        if device_color is not None:
+            parts.append(
+                f'{DEVICE_STYLES[device_color]}{" " * DEVICE_WIDTH}{RESET}'
+            )
+        if has_owner:
+            parts.append(f'{OWNER_STYLE}{" " * OWNER_WIDTH}{RESET}')
+        if has_thread:
+            parts.append(f'{THREAD_STYLE}{" " * THREAD_WIDTH}{RESET}')
+        if time_width:
+            parts.append(f'{TIME_STYLE}{" " * time_width}{RESET}')
+        if tag_color is not None:
+            parts.append(f'{TAG_STYLES[tag_color]}{" " * TAG_WIDTH}{RESET}')
+        if has_tag_type:
+            parts.append(
+                f'{EMPTY_TAG_TYPE_STYLE}{" " * TAG_TYPE_WIDTH}{RESET} '
+            )
+        header = "".join(parts)
+        CONTINUATION_HEADERS[layout] = header
+    return header
+
+
+def char_width(char):
+    """
+    @brief
+
+    @param char Character other than a tab or a printable ASCII one.
+
+    @return Columns it takes on a terminal: 2 for the East Asian wide and
+            full width characters, 0 for the combining and control ones, 1
+            otherwise.
+    """
+    width = CHAR_WIDTHS.get(char)
+    if width is None:
+        if (unicodedata.combining(char)
+                or unicodedata.category(char) in ("Cc", "Cf")):
+            width = 0
+        elif unicodedata.east_asian_width(char) in ("W", "F"):
+            width = 2
+        else:
+            width = 1
+        CHAR_WIDTHS[char] = width
+    return width
+
+
+def wrap_points(msg, header_size):
+    """
+    @brief Find where a message is wrapped, in a single scan of it.
+
+    The message starts after the header and each wrapped part after a blank
+    header of the same size. The tabs go to the next tab stop of the line,
+    and a wide character is not split over two lines.
+
+    @param msg
+    @param header_size Columns of the header before the message.
+
+    @return Iterable of the indexes of msg starting a new line.
+    """
+    wrap_area = WIDTH - header_size
+    if wrap_area < 1:
+        return ()
+    if msg.isascii() and "\t" not in msg:
+        return range(wrap_area, len(msg), wrap_area)
+
+    points = []
+    column = header_size
+    for match in rewrapsegment.finditer(msg):
+        segment = match.group()
+        start = match.start()
+        if len(segment) > 1 or " " <= segment <= "~":
+            # One column per character, the run may span several lines
+            end = match.end()
+            while column + end - start > WIDTH:
+                start += max(WIDTH - column, 0)
+                points.append(start)
+                column = header_size
+            column += end - start
+            continue
+
+        if segment == "\t":
+            width = TAB_SIZE - column % TAB_SIZE
+        else:
+            width = char_width(segment)
+        if column + width > WIDTH and column > header_size:
+            points.append(start)
+            column = header_size
+            if segment == "\t":
+                width = TAB_SIZE - column % TAB_SIZE
+        column += width
+    return points
+
+
+def print_msg(linebuf, colorless, layout, header_size, msg):
+    """
+    @brief Write a message, wrapped to the width of the terminal.
+
+    Each part of the message is sliced once for both outputs.
+
+    @param linebuf
+    @param colorless
+    @param layout Header layout, see continuation_header().
+    @param header_size
+    @param msg
+    """
+    start = 0
+    for point in wrap_points(msg, header_size):
+        part = msg[start:point]
+        linebuf.write(part)
+        linebuf.write("\n" + continuation_header(layout))
+        colorless.write(part)
+        colorless.write("\n" + " " * header_size)
+        start = point
+    part = msg[start:]
+    linebuf.write(part)
+    colorless.write(part)
+
+
+def print_device(linebuf, colorless, device):
+    """
+    @brief
+
+    @param linebuf
+    @param colorless
+    @param device Tuple of the color and the title of the device, see
+                  device_title().
+
+    @return
+    """
+    color, title = device
+    linebuf.write(f'{DEVICE_STYLES[color]}{title}{RESET}')
+    colorless.write(title)
+    return DEVICE_WIDTH
+
+
+def device_title(serial, color):
+    """
+    @brief
+
+    @param serial Serial number of the device.
+    @param color Color of the device.
+
+    @return Tuple of the color and the centered title of the device.
+    """
+    return color, serial[-(DEVICE_WIDTH - 2):].center(DEVICE_WIDTH)
+
+
+def render_record(record, device=None, pattern=None):
+    """
+    @brief Format a parsed line.
+
+    @param record LogRecord of the line.
+    @param device Device the line comes from, see device_title(), or None.
+    @param pattern Pattern of -K found in the message, shown in front of it,
+                   or None.
+
+    @return Tuple of the colored and the colorless texts, newline included.
+    """
+    linebuf = StringIO()
+    colorless = StringIO()
+    header_size = 0
+    date, owner, thread, tag_type, tag, msg = record
+
+    tag_color = None
+    if tag is not None:
+        tag_color, tag = tag_style(tag)
+    time_width = 0
+
+    if pattern is not None and msg is not None:
+        msg = f"[{pattern}] {msg}"
+
+    # Print parts
+    if device is not None:
+        header_size += print_device(linebuf, colorless, device)
+
+    if owner is not None:
+        header_size += print_owner(linebuf, colorless, owner)
+
+    if thread is not None:
+        header_size += print_thread(linebuf, colorless, thread)
+
+    if date is not None:
+        time_width = print_time(linebuf, colorless, date)
+        header_size += time_width
+
+    if tag is not None:
+        header_size += print_tag(linebuf, colorless, tag, tag_color)
+
+    if tag_type is not None:
+        header_size += print_tag_type(linebuf, colorless, tag_type)
+
+    if msg is not None:
+        layout = (None if device is None else device[0], owner is not None,
+                  thread is not None, time_width, tag_color,
+                  tag_type is not None)
+        print_msg(linebuf, colorless, layout, header_size, msg)
+
+    linebuf.write("\n")
+    colorless.write("\n")
+    return linebuf.getvalue(), colorless.getvalue()
+
+
+def render_unparsed(line, device=None):
+    """
+    @brief Format a line in none of the handled formats.
+
+    The beginning of buffer banners are centered, other lines are kept as
+    they are.
+
+    @param line
+    @param device Device the line comes from, see device_title(), or None.
+
+    @return Tuple of the colored and the colorless texts.
+    """
+    matchbeginning = rebeginning.match(line)
+    if matchbeginning is not None:
+        msg, line = matchbeginning.groups()
+        rendered = ("{}{}{}\n".format(
+                        BEGINNING_STYLE,
+                        (f"Beginning of {msg}{line}").center(WIDTH),
+                        RESET
+                    ),
+                    "Beginning of {msg}{line}".center(WIDTH))
+    else:
+        rendered = line + "\n", line
+    if device is None:
+        return rendered
+    color, title = device
+    return (f'{DEVICE_STYLES[color]}{title}{RESET}{rendered[0]}',
+            title + rendered[1])
+
+
+def render_dropped(count):
+    """
+    @brief Format the notice of the lines dropped by the LineRing.
+
+    @param count Lines dropped since the last notice.
+
+    @return Tuple of the colored and the colorless texts.
+    """
+    notice = f"Dropped {count} lines".center(WIDTH)
+    return f"{BEGINNING_STYLE}{notice}{RESET}\n", notice + "\n"
+
+
+def render_line(line, parser, line_filter=None, device=None, store=None):
+    """
+    @brief Parse, filter and format a line read from the input.
+
+    The lines in none of the handled formats are kept as they are.
+
+    @param line
+    @param parser LogcatParser to use.
+    @param line_filter LineFilter to apply, None to show every line.
+    @param device Device the line comes from, see device_title(), or None.
+    @param store RecordStore keeping the parsed lines, filtered or not, or
+                 None.
+
+    @return Tuple of the colored and the colorless texts, None if the line is
+            filtered out.
+    """
+    if line.startswith(BEGINNING_PREFIX):
+        return render_unparsed(line, device)
+
+    record = parser.parse(line)
+    if record is None:
+        return render_unparsed(line, device)
+
+    if store is not None:
+        store.append(record)
+
+    if line_filter is None:
+        return render_record(record, device)
+    if not line_filter.accept(record):
+        return None
+    return render_record(record, device, line_filter.pattern)
+
+
+def render_mapped(parser, start, end, line_filter=None):
+    """
+    @brief Parse, filter and format the lines of a memory mapped file.
+
+    The lines are matched in place and only the fields the filter needs are
+    copied, a line is decoded once it is shown.
+
+    @param parser MappedLogcatParser of the mapping.
+    @param start Offset of the first line.
+    @param end Offset of the end of the last line.
+    @param line_filter MappedLineFilter to apply, None to show every line.
+
+    @return Generator of the colored and colorless texts of the shown lines.
+    """
+    mapping = parser.mapping
+    find = mapping.find
+    timed = line_filter is not None and (line_filter.since is not None
+                                         or line_filter.until is not None)
+    while start < end:
+        line_end = find(b"\n", start, end)
+        if line_end < 0:
+            line_end = next_start = end
+        else:
+            next_start = line_end + 1
+
+        match = parser.match(start, line_end)
+        if match is None:
+            yield render_unparsed(
+                mapping[start:next_start].decode(errors="replace"))
+            start = next_start
+            continue
+        start = next_start
+
+        # The lines are in time order, stop after the last one of the range
+        if timed and parser.logcat_format in DATED_FORMATS:
+            key = date_key(match.group(1, 2, 3, 4, 5, 6))
+            if line_filter.until is not None and key > line_filter.until:
+                break
+            if line_filter.since is not None and key < line_filter.since:
+                continue
+
+        if line_filter is None:
+            yield render_record(parser.record(match))
+        elif line_filter.accept_match(match, parser.groups):
+            yield render_record(parser.record(match),
+                                pattern=line_filter.pattern)
+
+
+def batch_ids(rows, group):
+    """
+    @brief
+
+    @param rows Groups of the lines of a batch.
+    @param group Number of the group of a process or thread id.
+
+    @return numpy array of the ids, -1 for the lines without one.
+    """
+    column = numpy.array([row[group - 1] or b"-1" for row in rows])
+    try:
+        return column.astype(numpy.int64)
+    except ValueError:
+        return numpy.array([parse_id(value) or -1 for value in column],
+                           numpy.int64)
+
+
+def batch_keys(rows):
+    """
+    @brief
+
+    @param rows Groups of the lines of a batch in a dated format.
+
+    @return numpy array of the date keys in milliseconds (see key_nanos()),
+            -1 for the lines without date.
+    """
+    fields = [numpy.array([row[index] or b"0" for row in rows]).astype(
+        numpy.int64) for index in range(5)]
+    fraction = numpy.array([row[5] or b"0" for row in rows])
+    month, day, hours, minutes, seconds = fields
+    keys = (((((month * 32 + day) * 24 + hours) * 60 + minutes) * 60
+             + seconds) * 1000 + fraction.astype(numpy.int64) * 1000
+            // 10 ** numpy.char.str_len(fraction))
+    keys[month == 0] = -1
+    return keys
+
+
+def batch_filter_numpy(rows, groups, dated, line_filter):
+    """
+    @brief Filter the lines of a batch with numpy masks, see batch_filter().
+    """
+    type_group, tag_group, msg_group, owner_group, thread_group = groups
+    levels = numpy.frombuffer(
+        b"".join([row[type_group - 1] or b"\0" for row in rows]), numpy.uint8)
+    parsed = levels != 0
+    shown = parsed.copy()
+    stop = None
+    patterns = {}
+
+    if line_filter.min_level is not None:
+        shown &= LEVEL_CODES[levels] >= line_filter.min_level
+    if line_filter.pids is not None:
+        if owner_group is None:
+            shown[:] = False
+        else:
+            shown &= numpy.isin(batch_ids(rows, owner_group),
+                                list(line_filter.pids))
+    if line_filter.tids is not None:
+        if thread_group is None:
+            shown[:] = False
+        else:
+            shown &= numpy.isin(batch_ids(rows, thread_group),
+                                list(line_filter.tids))
+
+    if dated and (line_filter.since is not None
+                  or line_filter.until is not None):
+        keys = batch_keys(rows)
+        if line_filter.until is not None:
+            past = numpy.flatnonzero(
+                keys > key_nanos(line_filter.until) // 1000000)
+            if len(past):
+                stop = past[0]
+        if line_filter.since is not None:
+            shown &= (keys >= key_nanos(line_filter.since) // 1000000) | (
+                keys < 0)
+
+    if (line_filter.re_tag_filter is not None
+            or line_filter.re_msg_filter is not None):
+        matched = numpy.zeros(len(rows), bool)
+        if line_filter.re_tag_filter is not None and tag_group is not None:
+            # Once per distinct tag, broadcast to the lines
+            tags, lines_tag = numpy.unique(
+                numpy.array([row[tag_group - 1] for row in rows]),
+                return_inverse=True)
+            verdicts = numpy.array([line_filter.tag_match(tag)
+                                    for tag in tags.tolist()], bool)
+            matched |= verdicts[lines_tag.reshape(-1)]
+        if line_filter.keywords:
+            # The messages of the lines matched by their tag are searched too,
+            # for the pattern labelling them
+            for index in numpy.flatnonzero(shown).tolist():
+                if line_filter.msg_match(rows[index][msg_group - 1]):
+                    matched[index] = True
+                    patterns[index] = line_filter.pattern
+        elif line_filter.re_msg_filter is not None:
+            for index in numpy.flatnonzero(shown & ~matched).tolist():
+                matched[index] = line_filter.msg_match(
+                    rows[index][msg_group - 1])
+        shown &= matched
+
+    # The lines in none of the formats are always shown
+    shown |= ~parsed
+    if stop is not None:
+        shown[stop:] = False
+    return numpy.flatnonzero(shown).tolist(), stop, patterns
+
+
+def batch_filter(rows, groups, dated, line_filter):
+    """
+    @brief Filter the lines of a batch, column by column.
+
+    Same verdicts as render_mapped(): the level, process, thread and time of
+    the lines are compared a column at a time (as numpy masks when numpy is
+    available), the tag filter runs once per distinct tag and the message
+    filter only on the lines still shown.
+
+    @param rows Groups of the lines of the batch, see BATCH_FORMATS.
+    @param groups Group numbers of the fields, see FORMAT_GROUPS.
+    @param dated Whether the format gives the date of the lines.
+    @param line_filter MappedLineFilter to apply.
+
+    @return Tuple of the indexes of the lines shown, of the index of the
+            first line past the end of the time range, None if there is none,
+            and of the patterns of -K found in the messages of the lines shown
+            by index.
+    """
+    if numpy is not None:
+        return batch_filter_numpy(rows, groups, dated, line_filter)
+
+    type_group, tag_group, msg_group, owner_group, thread_group = groups
+    since = line_filter.since
+    until = line_filter.until
+    timed = dated and (since is not None or until is not None)
+    text_filter = (line_filter.re_tag_filter is not None
+                   or line_filter.re_msg_filter is not None)
+    tag_verdicts = {}
+    shown = []
+    patterns = {}
+    for index, row in enumerate(rows):
+        tag_type = row[type_group - 1]
+        if not tag_type:
+            shown.append(index)
+            continue
+
+        if timed:
+            key = date_key(row[:6])
+            if until is not None and key > until:
+                return shown, index, patterns
+            if since is not None and key < since:
+                continue
+
+        if (line_filter.min_level is not None
+                and LEVEL_PRIORITY[tag_type] < line_filter.min_level):
+            continue
+        if line_filter.pids is not None and (
+                owner_group is None
+                or parse_id(row[owner_group - 1]) not in line_filter.pids):
+            continue
+        if line_filter.tids is not None and (
+                thread_group is None
+                or parse_id(row[thread_group - 1]) not in line_filter.tids):
+            continue
+
+        if line_filter.keywords:
+            # The message first, for the pattern labelling the line
+            if line_filter.msg_match(row[msg_group - 1]):
+                patterns[index] = line_filter.pattern
+            elif not (line_filter.re_tag_filter is not None and tag_group
+                      and line_filter.tag_match(row[tag_group - 1])):
+                continue
+        elif text_filter:
+            verdict = False
+            if line_filter.re_tag_filter is not None and tag_group:
+                tag = row[tag_group - 1]
+                verdict = tag_verdicts.get(tag)
+                if verdict is None:
+                    verdict = tag_verdicts[tag] = line_filter.tag_match(tag)
+            if not verdict and not (line_filter.re_msg_filter is not None
+                                    and line_filter.msg_match(
+                                        row[msg_group - 1])):
+                continue
+        shown.append(index)
+    return shown, None, patterns
+
+
+def render_batched(parser, start, end, line_filter):
+    """
+    @brief Same as render_mapped(), filtering the lines by batches.
+
+    A batch of about BATCH_SIZE bytes is split in the groups of its lines by a
+    single findall(), filtered by batch_filter(), and only the lines shown are
+    decoded and rendered.
+
+    @param parser MappedLogcatParser of the mapping.
+    @param start Offset of the first line.
+    @param end Offset of the end of the last line.
+    @param line_filter MappedLineFilter to apply.
+
+    @return Generator of the colored and colorless texts of the shown lines.
+    """
+    mapping = parser.mapping
+    if parser.logcat_format is None:
+        parser.select(FORMAT_PRIORITY[0])
+    switched = False
+    while start < end:
+        batch_end = mapping.find(b"\n", min(start + BATCH_SIZE, end) - 1, end)
+        batch_end = end if batch_end < 0 else batch_end + 1
+        # Leave the last newline out, or findall() would see an empty line
+        # after it
+        stop = batch_end - 1 if mapping[batch_end - 1] == ord("\n") else end
+
+        logcat_format = parser.logcat_format
+        rows = BATCH_FORMATS[logcat_format].findall(mapping, start, stop)
+        type_index = parser.groups[0] - 1
+
+        # A line of another format switches the parser to it, as in
+        # render_mapped(), and the batch is split again. A file mixing
+        # formats is left to render_mapped().
+        foreign = next((row[-1] for row in rows if not row[type_index]
+                        and any(regex.match(row[-1])
+                                for regex in MAPPED_FORMATS.values())), None)
+        if foreign is not None:
+            if switched:
+                yield from render_mapped(parser, start, end, line_filter)
+                return
+            for other in FORMAT_PRIORITY:
+                if MAPPED_FORMATS[other].match(foreign):
+                    parser.select(other)
+                    break
+            switched = True
+            continue
+        switched = False
+
+        shown, past, patterns = batch_filter(rows, parser.groups,
+                                             logcat_format in DATED_FORMATS,
+                                             line_filter)
+        unpack = parser.unpack
+        last = len(rows) - 1
+        for index in shown:
+            row = rows[index]
+            if not row[type_index]:
+                # With its newline, but the one missing at the end of a file
+                newline = "" if index == last and stop == batch_end else "\n"
+                yield render_unparsed(row[-1].decode(errors="replace")
+                                      + newline)
+            else:
+                yield render_record(unpack(tuple(
+                    group.decode(errors="replace") for group in row[:-1])),
+                    pattern=patterns.get(index))
+        if past is not None:
+            return
+        start = batch_end
+
+
+def first_dated_line(parser, start, end):
+    """
+    @brief Find the first line giving its date in a part of a mapped file.
+
+    @param parser MappedLogcatParser of the mapping.
+    @param start Offset of a line.
+    @param end Offset where to stop looking.
+
+    @return Tuple of the date key, offset and offset of the next line of the
+            first dated line, None if there is none.
+    """
+    mapping = parser.mapping
+    while start < end:
+        line_end = mapping.find(b"\n", start, end)
+        if line_end < 0:
+            line_end = next_start = end
+        else:
+            next_start = line_end + 1
+        match = parser.match(start, line_end)
+        if match is not None and parser.logcat_format in DATED_FORMATS:
+            return date_key(match.group(1, 2, 3, 4, 5, 6)), start, next_start
+        start = next_start
+    return None
+
+
+def seek_time(parser, size, since):
+    """
+    @brief Bisect a mapped file, in time order, for the first line of a range.
+
+    The bisection works on byte offsets and stops once the range is under
+    SEEK_WINDOW, the lines before the first one in range are then skipped
+    while reading.
+
+    @param parser MappedLogcatParser of the mapping.
+    @param size Size of the file.
+    @param since Date key of the start of the range.
+
+    @return Offset of a line at or before the first line in range.
+    """
+    mapping = parser.mapping
+    low = 0
+    high = size
+    while high - low > SEEK_WINDOW:
+        middle = (low + high) // 2
+        line_start = mapping.find(b"\n", middle, high) + 1
+        found = None
+        if line_start > 0:
+            found = first_dated_line(parser, line_start, high)
+        if found is None or found[0] >= since:
+            high = middle
+        else:
+            low = found[2]
+    return low
+
+
+def render_file(fd, logcat_format, line_filter, output, writefile):
+    """
+    @brief Render a file through a memory mapping of it.
+
+    @param fd File descriptor of the input file.
+    @param logcat_format Expected format of the lines.
+    @param line_filter MappedLineFilter to apply, or None.
+    @param output BatchWriter of the colored output.
+    @param writefile BatchWriter of the colorless output, or None.
+    """
+    size = os.fstat(fd).st_size
+    if size == 0:
+        return
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapping:
+        parser = MappedLogcatParser(mapping, logcat_format)
+        start = 0
+        if line_filter is not None and line_filter.since is not None:
+            start = seek_time(parser, size, line_filter.since)
+        render = render_mapped if line_filter is None else render_batched
+        for colored, colorless in render(parser, start, size, line_filter):
+            output.write(colored)
+            if writefile is not None:
+                writefile.write(colorless)
+
+
+def add_posting(postings, key, number):
     """
-    @brief
-
-    @param fgd
-    @param bgd
-    @param bright
-    @param dim
-    @param reset
+    @brief Add a line number to the posting list of a key.
 
-    @return
+    @param postings Dictionary of the posting lists.
+    @param key
+    @param number Line number.
     """
-    # manually derived from http://en.wikipedia.org/wiki/ANSI_escape_code#Codes
-    codes = []
-    if reset:
-        codes.append("0")
-    else:
-        if fgd is not None:
-            codes.append("3%d" % (fgd))
-        if bgd is not None:
-            if not bright:
-                codes.append("4%d" % (bgd))
-            else:
-                codes.append("10%d" % (bgd))
-        if dim:
-            codes.append("2")
-        else:
-            codes.append("22")
-    return "\033[%sm" % (";".join(codes))
+    lines = postings.get(key)
+    if lines is None:
+        lines = postings[key] = array("I")
+    lines.append(number)
 
 
-OWNER_WIDTH = 7
-THREAD_WIDTH = 7
-TIME_WIDTH = 20
-TAG_WIDTH = 26
-TAG_TYPE_WIDTH = 3
+def build_index(path, logcat_format=None):
+    """
+    @brief Parse a log file once and write its sidecar index.
 
-TAG_TYPE_FORMAT = {
-    "V": style_fmt(fgd=WHITE, bgd=BLACK),
-    "D": style_fmt(fgd=BLACK, bgd=BLUE),
-    "I": style_fmt(fgd=BLACK, bgd=GREEN),
-    "W": style_fmt(fgd=BLACK, bgd=YELLOW),
-    "E": style_fmt(fgd=BLACK, bgd=RED),
-    "F": style_fmt(fgd=RED, bgd=WHITE),
-    "S": style_fmt(fgd=BLACK, bgd=CYAN),
-}
+    The index holds the offset of every line and, as posting lists of line
+    numbers, the lines of each tag, level, process id, thread id and minute,
+    as well as the lines in none of the handled formats. It is written next to
+    the file, with the INDEX_SUFFIX extension.
 
-rebeginning = re.compile(r"^--------- beginning of ([^\)]+)([^\(]+)\r$")
-rethreadtime = re.compile(r"^(\d+)-(\d+) (\d+):(\d+):(\d+).(\d+)([^\)]+) "
-                          r"([^\)]+) ([VDIWEFS]) ([^\(]+?): (.*)$")
-retime = re.compile(r"^(\d+)-(\d+) (\d+):(\d+):(\d+).(\d+) "
-                    r"([VDIWEFS])/([^\(]+)\(([^\)]+)\): (.*)$")
-rethread = re.compile(r"^([VDIWEFS])\(([^\)]+):([^\)]+)\) (.*)$")
-rebrief = re.compile(r"^([VDIWEFS])/([^\(]+)\(([^\)]+)\): (.*)$")
-retag = re.compile(r"^([VDIWEFS])/([^\(]+?): (.*)$")
+    @param path Path of the log file.
+    @param logcat_format Expected format of the lines.
 
+    @return The index.
+    """
+    offsets = array("Q")
+    unparsed = array("I")
+    tags = {}
+    levels = {}
+    pids = {}
+    tids = {}
+    minutes = {}
+    dated = False
+
+    with open(path, 'rb') as logfile:
+        info = os.fstat(logfile.fileno())
+        size = info.st_size
+        mapping = None
+        if size:
+            mapping = mmap.mmap(logfile.fileno(), 0, access=mmap.ACCESS_READ)
+            parser = MappedLogcatParser(mapping, logcat_format)
+        start = 0
+        while start < size:
+            number = len(offsets)
+            offsets.append(start)
+            line_end = mapping.find(b"\n", start)
+            if line_end < 0:
+                line_end = next_start = size
+            else:
+                next_start = line_end + 1
+            match = parser.match(start, line_end)
+            start = next_start
 
-def print_owner(linebuf, colorless, empty_header, owner):
+            if match is None:
+                unparsed.append(number)
+                continue
+            type_group, tag_group, _, owner_group, thread_group = parser.groups
+            add_posting(levels, match.group(type_group), number)
+            if tag_group:
+                add_posting(tags, match.group(tag_group), number)
+            if owner_group:
+                add_posting(pids, parse_id(match.group(owner_group)), number)
+            if thread_group:
+                add_posting(tids, parse_id(match.group(thread_group)), number)
+            if parser.logcat_format in DATED_FORMATS:
+                # "MM-DD HH:MM" of the line
+                dated = True
+                add_posting(minutes, mapping[match.start(1):match.end(4)],
+                            number)
+        offsets.append(size)
+        if mapping is not None:
+            mapping.close()
+
+    index = {
+        "version": INDEX_VERSION,
+        "size": size,
+        "mtime": info.st_mtime_ns,
+        "offsets": offsets,
+        "unparsed": unparsed,
+        "tags": tags,
+        "levels": levels,
+        "pids": pids,
+        "tids": tids,
+        "minutes": minutes,
+        "dated": dated,
+    }
+    write_index(path, index)
+    return index
+
+
+def write_index(path, index):
     """
-    @brief
+    @brief Write the sidecar index of a log file.
 
-    @param linebuf
-    @param colorless
-    @param empty_header
-    @param owner
+    The file starts with a JSON header line giving the date of the log file
+    and the layout of the arrays of the index, each one being then written
+    raw with array.tofile(), in the order of the header. Nothing in it is
+    executed when it is read back.
 
-    @return
+    @param path Path of the log file.
+    @param index Index of the file, see build_index().
     """
-    # center process owner info
-    owner = owner.strip().center(OWNER_WIDTH)
-    linebuf.write(
-        "{}{}{}".format(
-            style_fmt(fgd=CYAN, bgd=BLACK),
-            owner,
-            style_fmt(reset=True)
-        )
-    )
-    colorless.write(f'{owner}')
-    empty_header.write(
-        "{}{}{}".format(
-            style_fmt(fgd=CYAN, bgd=BLACK),
-            " " * OWNER_WIDTH,
-            style_fmt(reset=True)
-        )
-    )
-    return OWNER_WIDTH
+    blocks = []
+    arrays = []
+    for section in ("offsets", "unparsed"):
+        blocks.append([section, None, index[section].typecode,
+                       index[section].itemsize, len(index[section])])
+        arrays.append(index[section])
+    for section, text_keys in INDEX_POSTINGS.items():
+        for key, postings in index[section].items():
+            if text_keys:
+                key = key.decode("latin-1")
+            blocks.append([section, key, postings.typecode,
+                           postings.itemsize, len(postings)])
+            arrays.append(postings)
+    header = {
+        "version": INDEX_VERSION,
+        "size": index["size"],
+        "mtime": index["mtime"],
+        "dated": index["dated"],
+        "byteorder": sys.byteorder,
+        "blocks": blocks,
+    }
+    with open(path + INDEX_SUFFIX, 'wb') as indexfile:
+        indexfile.write(json.dumps(header).encode() + b"\n")
+        for postings in arrays:
+            postings.tofile(indexfile)
+
+
+def load_index(path):
+    """
+    @brief Read the sidecar index of a log file, see write_index().
 
+    @param path Path of the log file.
 
-def print_thread(linebuf, colorless, empty_header, thread):
+    @return The sidecar index of the file, None if there is none, if it is
+            out of date or if it is damaged.
     """
-    @brief
+    try:
+        info = os.stat(path)
+        with open(path + INDEX_SUFFIX, 'rb') as indexfile:
+            header = json.loads(indexfile.readline())
+            if (not isinstance(header, dict)
+                    or header.get("version") != INDEX_VERSION
+                    or header.get("byteorder") != sys.byteorder
+                    or header.get("size") != info.st_size
+                    or header.get("mtime") != info.st_mtime_ns
+                    or not isinstance(header.get("dated"), bool)
+                    or not isinstance(header.get("blocks"), list)):
+                return None
+            index = {section: {} for section in INDEX_POSTINGS}
+            index.update(size=header["size"], mtime=header["mtime"],
+                         dated=header["dated"])
+            for block in header["blocks"]:
+                section, key, typecode, itemsize, count = block
+                if (typecode not in ("I", "Q")
+                        or array(typecode).itemsize != itemsize):
+                    return None
+                postings = array(typecode)
+                postings.fromfile(indexfile, count)
+                if section in ("offsets", "unparsed") and key is None:
+                    index[section] = postings
+                elif section in INDEX_POSTINGS and INDEX_POSTINGS[section]:
+                    index[section][key.encode("latin-1")] = postings
+                elif section in INDEX_POSTINGS and (
+                        key is None or isinstance(key, int)):
+                    index[section][key] = postings
+                else:
+                    return None
+            if indexfile.read(1):
+                return None
+    except (OSError, EOFError, ValueError, TypeError, AttributeError):
+        return None
+
+    # Every line number must be one of the offsets
+    lines = len(index.get("offsets", ())) - 1
+    if lines < 0 or "unparsed" not in index:
+        return None
+    for postings in (index["unparsed"],
+                     *(postings for section in INDEX_POSTINGS
+                       for postings in index[section].values())):
+        if postings and max(postings) >= lines:
+            return None
+    return index
+
+
+def index_lines(index, line_filter):
+    """
+    @brief Use the index to find the lines that can pass the filter.
 
-    @param linebuf
-    @param colorless
-    @param empty_header
-    @param thread
+    The level, process, thread and time filters always narrow the lines, the
+    tag filter only when there is no message filter since a line is then shown
+    when either of them matches. The time range keeps the lines of the minutes
+    it overlaps, the rest of the range being checked on each line. The lines
+    in none of the formats are always part of the result, like when reading
+    the whole file.
 
-    @return
+    @param index Index of the file.
+    @param line_filter MappedLineFilter to apply.
+
+    @return Sorted list of line numbers, None if the index cannot narrow the
+            lines.
     """
-    # center thread info
-    thread = thread.strip().center(THREAD_WIDTH)
-    linebuf.write(
-        "{}{}{}".format(
-            style_fmt(fgd=CYAN, bgd=BLACK),
-            thread,
-            style_fmt(reset=True)
-        )
-    )
-    colorless.write(f'{thread}')
-    empty_header.write(
-        "{}{}{}".format(
-            style_fmt(fgd=CYAN, bgd=BLACK),
-            " " * THREAD_WIDTH,
-            style_fmt(reset=True)
-        )
-    )
-    return THREAD_WIDTH
+    candidates = []
+    if (line_filter.re_tag_filter is not None
+            and line_filter.re_msg_filter is None):
+        lines = set()
+        for tag, postings in index["tags"].items():
+            if line_filter.tag_match(tag):
+                lines.update(postings)
+        candidates.append(lines)
+    if line_filter.min_level is not None:
+        lines = set()
+        for level, postings in index["levels"].items():
+            if LEVEL_PRIORITY.get(level, 0) >= line_filter.min_level:
+                lines.update(postings)
+        candidates.append(lines)
+    for ids, postings in ((line_filter.pids, index["pids"]),
+                          (line_filter.tids, index["tids"])):
+        if ids is not None:
+            lines = set()
+            for id_value in ids:
+                lines.update(postings.get(id_value, ()))
+            candidates.append(lines)
+    if index["dated"] and (line_filter.since is not None
+                           or line_filter.until is not None):
+        lines = set()
+        for minute, postings in index["minutes"].items():
+            match = reindexminute.match(minute)
+            if match is not None:
+                key = tuple(map(int, match.groups()))
+                if ((line_filter.since is not None
+                     and key < line_filter.since[:4])
+                        or (line_filter.until is not None
+                            and key > line_filter.until[:4])):
+                    continue
+            lines.update(postings)
+        candidates.append(lines)
+
+    if not candidates:
+        return None
+    candidates.sort(key=len)
+    lines = candidates[0]
+    for other in candidates[1:]:
+        lines.intersection_update(other)
+    lines.update(index["unparsed"])
+    return sorted(lines)
+
+
+def index_until(index, parser, until):
+    """
+    @brief Use the minutes of the index to find the end of a time range.
 
+    @param index Index of the file.
+    @param parser MappedLogcatParser of the mapping of the file.
+    @param until Date key of the end of the range.
 
-def print_time(linebuf, colorless, empty_header, date):
+    @return Number of the first dated line past the range, the number of
+            lines of the file if there is none.
     """
-    @brief
+    offsets = index["offsets"]
+    past = len(offsets) - 1
+    for minute, postings in index["minutes"].items():
+        match = reindexminute.match(minute)
+        if match is None or not postings:
+            continue
+        key = tuple(map(int, match.groups()))
+        if key > until[:4]:
+            past = min(past, postings[0])
+        elif key == until[:4]:
+            # Only the seconds tell whether the lines of the last minute are
+            # in the range
+            for number in postings:
+                if number >= past:
+                    break
+                line = parser.match(offsets[number],
+                                    offsets[number + 1] - 1)
+                if (line is not None
+                        and date_key(line.group(1, 2, 3, 4, 5, 6)) > until):
+                    past = number
+                    break
+    return past
+
+
+def render_indexed(fd, index, lines, logcat_format, line_filter, output,
+                   writefile):
+    """
+    @brief Render the given lines of a file, found with its index.
+
+    Each line still goes through the whole filter, the index only skips the
+    lines that cannot pass it. With a time range, the lines shown are
+    between the same bounds as when reading the file: from the line
+    seek_time() finds to the first dated line past the range.
+
+    @param fd File descriptor of the input file.
+    @param index Index of the file.
+    @param lines Sorted line numbers to render.
+    @param logcat_format Expected format of the lines.
+    @param line_filter MappedLineFilter to apply.
+    @param output BatchWriter of the colored output.
+    @param writefile BatchWriter of the colorless output, or None.
+    """
+    if not lines:
+        return
+    offsets = index["offsets"]
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapping:
+        parser = MappedLogcatParser(mapping, logcat_format)
+        if index["dated"]:
+            first = 0
+            past = len(offsets) - 1
+            if line_filter.since is not None:
+                first = bisect.bisect_left(
+                    offsets, seek_time(parser, len(mapping),
+                                       line_filter.since))
+            if line_filter.until is not None:
+                past = index_until(index, parser, line_filter.until)
+            lines = lines[bisect.bisect_left(lines, first):
+                          bisect.bisect_left(lines, past)]
+        for number in lines:
+            for colored, colorless in render_mapped(parser, offsets[number],
+                                                    offsets[number + 1],
+                                                    line_filter):
+                output.write(colored)
+                if writefile is not None:
+                    writefile.write(colorless)
+
+
+def split_chunks(fd, size, start=0):
+    """
+    @brief Cut a file in chunks of about CHUNK_SIZE bytes ending on a line
+           boundary.
 
-    @param linebuf
-    @param colorless
-    @param empty_header
-    @param m
-    @param d
-    @param h
-    @param mi
-    @param s
-    @param ms
+    @param fd File descriptor of the file.
+    @param size Size of the file.
+    @param start Offset of the first line of the first chunk.
 
-    @return
+    @return Generator of (start, end) byte offsets.
     """
-    linebuf.write(
-        "{} {}-{} {}:{}:{}.{} {}".format(
-            style_fmt(fgd=GREEN, bgd=BLACK),
-            *date,
-            style_fmt(reset=True)
-        )
-    )
-    colorless.write(
-        " {}-{} {}:{}:{}.{} ".format(
-            *date
-        )
-    )
-    empty_header.write(
-        "{}{}{}".format(
-            style_fmt(fgd=GREEN, bgd=BLACK),
-            " " * TIME_WIDTH,
-            style_fmt(reset=True)
-        )
-    )
-    return TIME_WIDTH
+    while start < size:
+        end = start + CHUNK_SIZE
+        if end >= size:
+            end = size
+        else:
+            # Extend the chunk up to the end of its last line
+            while True:
+                data = os.pread(fd, 4096, end)
+                index = data.find(b"\n")
+                if index >= 0:
+                    end += index + 1
+                    break
+                if not data:
+                    end = size
+                    break
+                end += len(data)
+        yield start, end
+        start = end
+
+
+# Context of the processes of the parallel mode, set by init_worker()
+WORKER = {}
+
+
+def init_worker(fd, logcat_format, line_filter):
+    """
+    @brief Set up a process of the parallel mode.
 
+    @param fd File descriptor of the input file.
+    @param logcat_format Expected format of the lines.
+    @param line_filter MappedLineFilter to apply, or None.
+    """
+    global STABLE_COLORS
+    STABLE_COLORS = True
+    mapping = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    WORKER["parser"] = MappedLogcatParser(mapping, logcat_format)
+    WORKER["line_filter"] = line_filter
 
-def allocate_color(tag):
+
+def render_chunk(chunk):
     """
-    @brief
+    @brief Render a chunk of the input file in a process of the parallel mode.
 
-    @param tag
+    @param chunk Tuple (start, end) of byte offsets.
 
-    @return
+    @return Tuple of the colored and the colorless texts of the chunk.
     """
-    # this will allocate a unique format for the given tag
-    # since we don't have very many colors, we always keep track of the LRU
-    if tag not in KNOWN_TAGS:
-        KNOWN_TAGS[tag] = LAST_USED[0]
-    color = KNOWN_TAGS[tag]
-    LAST_USED.remove(color)
-    LAST_USED.append(color)
-    return color
+    start, end = chunk
+    colored = []
+    colorless = []
+    render = render_mapped if WORKER["line_filter"] is None else render_batched
+    for rendered in render(WORKER["parser"], start, end,
+                           WORKER["line_filter"]):
+        colored.append(rendered[0])
+        colorless.append(rendered[1])
+    return "".join(colored), "".join(colorless)
+
+
+def render_parallel(fd, jobs, logcat_format, line_filter, output, writefile):
+    """
+    @brief Render a file with a pool of processes.
+
+    The file is cut in line aligned chunks rendered by the processes, and
+    written back in their original order. At most two chunks per process are
+    in flight so memory stays bounded when the output is slower.
+
+    @param fd File descriptor of the input file.
+    @param jobs Number of processes.
+    @param logcat_format Expected format of the lines.
+    @param line_filter MappedLineFilter to apply, or None.
+    @param output BatchWriter of the colored output.
+    @param writefile BatchWriter of the colorless output, or None.
+    """
+    size = os.fstat(fd).st_size
+    if size == 0:
+        return
+    start = 0
+    if line_filter is not None and line_filter.since is not None:
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapping:
+            start = seek_time(MappedLogcatParser(mapping, logcat_format),
+                              size, line_filter.since)
+    context = multiprocessing.get_context("fork")
+    with context.Pool(jobs, init_worker,
+                      (fd, logcat_format, line_filter)) as pool:
+        pending = deque()
+        chunks = split_chunks(fd, size, start)
+        while True:
+            for chunk in chunks:
+                pending.append(pool.apply_async(render_chunk, (chunk,)))
+                if len(pending) >= 2 * jobs:
+                    break
+            if not pending:
+                break
+            colored, colorless = pending.popleft().get()
+            output.write(colored)
+            if writefile is not None:
+                writefile.write(colorless)
 
 
-def print_tag(linebuf, colorless, empty_header, tag):
+class DeviceMerger:
     """
-    @brief
+    @brief Merge the rendered lines of several devices in time order.
 
-    @param linebuf
-    @param colorless
-    @param empty_header
-    @param tag
+    The lines are held MERGE_DELAY seconds so that the late lines of the other
+    devices can still be sorted before them, then written in the order of
+    their date key. A device has at most DEVICE_BACKLOG lines held, its reader
+    waits when it reaches it.
+    """
 
-    @return
+    def __init__(self, output, writefile):
+        """
+        @brief
+
+        @param output BatchWriter of the colored output.
+        @param writefile BatchWriter of the colorless output, or None.
+        """
+        self.output = output
+        self.writefile = writefile
+        self._heap = []
+        self._count = 0
+        self._held = {}
+        self._room = asyncio.Condition()
+
+    async def push(self, serial, key, rendered):
+        """
+        @brief Hold a line until its release.
+
+        @param serial Serial number of the device of the line.
+        @param key Date key of the line.
+        @param rendered Tuple of the colored and the colorless texts.
+        """
+        async with self._room:
+            await self._room.wait_for(
+                lambda: self._held.get(serial, 0) < DEVICE_BACKLOG)
+            self._held[serial] = self._held.get(serial, 0) + 1
+        heapq.heappush(self._heap, (key, self._count, time.monotonic(),
+                                    serial, rendered))
+        self._count += 1
+
+    async def release(self, deadline):
+        """
+        @brief Write the held lines, by date, while the earliest one was
+               received before the deadline.
+
+        @param deadline Monotonic time.
+        """
+        while self._heap and self._heap[0][2] <= deadline:
+            _, _, _, serial, (colored, colorless) = heapq.heappop(self._heap)
+            self._held[serial] -= 1
+            self.output.write(colored)
+            if self.writefile is not None:
+                self.writefile.write(colorless)
+        async with self._room:
+            self._room.notify_all()
+
+    async def run(self):
+        """
+        @brief Release the lines held for MERGE_DELAY, until cancelled.
+        """
+        while True:
+            await asyncio.sleep(MERGE_TICK)
+            await self.release(time.monotonic() - MERGE_DELAY)
+
+
+async def follow_device(serial, device, command, logcat_format, line_filter,
+                        merger):
     """
-    # right-align tag title and allocate color if needed
-    tag = tag.strip()
-    color = allocate_color(tag)
-    tag = tag[-(TAG_WIDTH - 1):].rjust((TAG_WIDTH - 1))
-    linebuf.write(
-        "{}{} {}".format(
-            style_fmt(fgd=color),
-            tag,
-            style_fmt(reset=True)
-        )
-    )
-    colorless.write(f'{tag} ')
-    empty_header.write(
-        "{}{}{}".format(
-            style_fmt(fgd=color),
-            " " * TAG_WIDTH,
-            style_fmt(reset=True)
-        )
-    )
-    return TAG_WIDTH
+    @brief Run adb logcat on a device and feed its lines to the merger.
+
+    @param serial Serial number of the device.
+    @param device Tuple of the color and the title of the device.
+    @param command adb command line.
+    @param logcat_format Format asked to logcat.
+    @param line_filter LineFilter to apply, or None.
+    @param merger DeviceMerger of the lines.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *command, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL, limit=1024 * 1024)
+    parser = LogcatParser(logcat_format)
+    # Lines without date are sorted with the last dated line of the device
+    key = ()
+    try:
+        while True:
+            data = await process.stdout.readline()
+            if not data:
+                break
+            line = data.decode(errors="replace").replace("\r\n", "\n")
+
+            record = None
+            if not line.startswith(BEGINNING_PREFIX):
+                record = parser.parse(line)
+            if record is None:
+                rendered = render_unparsed(line, device)
+            elif line_filter is not None and not line_filter.accept(record):
+                continue
+            else:
+                if record.date is not None:
+                    key = date_key(record.date)
+                rendered = render_record(
+                    record, device,
+                    None if line_filter is None else line_filter.pattern)
+            await merger.push(serial, key, rendered)
+        await process.wait()
+    finally:
+        # Only when cancelled: killing an exited process would reap it behind
+        # the back of the asyncio child watcher
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+async def follow_devices(serials, logcat_format, logcat_options, line_filter,
+                         output, writefile):
+    """
+    @brief Follow the logs of several devices in a single stream.
+
+    @param serials Serial numbers of the devices.
+    @param logcat_format Format asked to logcat, it must give the date.
+    @param logcat_options Other options of logcat, as a list.
+    @param line_filter LineFilter to apply, or None.
+    @param output BatchWriter of the colored output.
+    @param writefile BatchWriter of the colorless output, or None.
+    """
+    merger = DeviceMerger(output, writefile)
+    releaser = asyncio.ensure_future(merger.run())
+    readers = []
+    for index, serial in enumerate(serials):
+        device = device_title(serial, TAG_COLORS[index % len(TAG_COLORS)])
+        command = (["adb", "-s", serial, "logcat", "-v", logcat_format]
+                   + logcat_options)
+        readers.append(follow_device(serial, device, command, logcat_format,
+                                     line_filter, merger))
+    try:
+        await asyncio.gather(*readers)
+    finally:
+        releaser.cancel()
+        await merger.release(float("inf"))
 
 
-def print_tag_type(linebuf, colorless, empty_header, tag_type):
+def list_devices():
     """
     @brief
 
-    @param linebuf
-    @param colorless
-    @param empty_header
-    @param tag_type
+    @return Serial numbers of the devices attached, from adb devices.
+    """
+    result = subprocess.run(["adb", "devices"], stdout=subprocess.PIPE,
+                            universal_newlines=True, check=False)
+    serials = []
+    for line in result.stdout.splitlines()[1:]:
+        fields = line.split()
+        if len(fields) == 2 and fields[1] == "device":
+            serials.append(fields[0])
+    return serials
 
-    @return
+
+def session_filter(text, store):
     """
-    linebuf.write(
-        "{}{}{} ".format(
-            TAG_TYPE_FORMAT[tag_type],
-            tag_type.center(TAG_TYPE_WIDTH),
-            style_fmt(reset=True)
-        )
-    )
-    colorless.write("{} ".format(tag_type.center(TAG_TYPE_WIDTH)))
+    @brief Build the filter of a command of the session prompt.
 
-    empty_header.write(
-        "{}{}{} ".format(
-            style_fmt(bgd=BLACK),
-            " " * TAG_TYPE_WIDTH,
-            style_fmt(reset=True)
-        )
-    )
-    return TAG_TYPE_WIDTH + 1
+    @param text Filter options, as on the command line: -T, -M, -A, -L, -i,
+                --pid, --tid, --since and --until.
+    @param store RecordStore of the session, its first date completes the
+                 times without date.
 
+    @return LineFilter, None to show every record.
 
-def print_msg(linebuf, colorless, empty_header, header_size, msg):
+    @exception ValueError Bad command.
     """
-    @brief
+    try:
+        opts, _ = getopt.getopt(shlex.split(text), "iA:T:M:L:",
+                                ["pid=", "tid=", "since=", "until="])
+    except getopt.GetoptError as err:
+        raise ValueError(str(err)) from err
 
-    @param linebuf
-    @param colorless
-    @param empty_header
-    @param header_size
-    @param msg
+    re_flags = 0
+    tag_exp = msg_exp = None
+    min_level = pids = tids = since = until = None
+    for opt, arg in opts:
+        if opt == "-i":
+            re_flags = re.IGNORECASE
+        elif opt == "-A":
+            tag_exp = msg_exp = arg
+        elif opt == "-T":
+            tag_exp = arg
+        elif opt == "-M":
+            msg_exp = arg
+        elif opt == "-L":
+            if arg.upper() not in LEVEL_PRIORITY:
+                raise ValueError("Bad level.")
+            min_level = LEVEL_PRIORITY[arg.upper()]
+        elif opt in ("--pid", "--tid"):
+            try:
+                ids = {int(value) for value in arg.split(",")}
+            except ValueError:
+                raise ValueError("Bad process or thread id.") from None
+            if opt == "--pid":
+                pids = ids
+            else:
+                tids = ids
+        else:
+            key = parse_time(arg)
+            if key is None:
+                raise ValueError("Bad time.")
+            if key[0] is None:
+                date = next((store.date(index) for index in range(len(store))
+                             if store.times[index] >= 0), None)
+                if date is None:
+                    today = datetime.date.today()
+                    key = (today.month, today.day, *key[2:])
+                else:
+                    key = (int(date[0]), int(date[1]), *key[2:])
+            if opt == "--since":
+                since = key
+            else:
+                until = key
 
-    @return
+    if not opts:
+        return None
+    try:
+        re_tag_filter = None if tag_exp is None else re.compile(tag_exp,
+                                                                re_flags)
+        re_msg_filter = None if msg_exp is None else re.compile(msg_exp,
+                                                                re_flags)
+    except re.error as err:
+        raise ValueError(f"Bad regular expression: {err}") from err
+    return LineFilter(re_tag_filter, re_msg_filter, min_level, pids, tids,
+                      since, until)
+
+
+def run_session(store, output):
     """
-    wrap_area = WIDTH - header_size
-    index_current = 0
+    @brief Prompt for filters on the terminal and show the records of the
+           session they accept, until "q" or the end of input.
 
-    while index_current < len(msg):
-        index_next = min(index_current + wrap_area - 6 * msg.count('\t'),
-                         len(msg))
+    @param store RecordStore of the session.
+    @param output BatchWriter to show the records on.
+    """
+    try:
+        prompt = open("/dev/tty", "w")
+        answers = open("/dev/tty")
+    except OSError:
+        print("No terminal for the session prompt.", file=sys.stderr)
+        return
+
+    with prompt, answers:
+        while True:
+            prompt.write(f"{len(store)} lines, filter (q to quit)> ")
+            prompt.flush()
+            try:
+                text = answers.readline()
+            except KeyboardInterrupt:
+                break
+            if not text or text.strip() in ("q", "quit"):
+                break
 
-        linebuf.write(msg[index_current:index_next])
-        colorless.write(msg[index_current:index_next])
+            try:
+                line_filter = session_filter(text, store)
+            except ValueError as err:
+                prompt.write(f"{err}\n")
+                continue
 
-        if index_next < len(msg):
-            linebuf.write("\n%s" % (empty_header.getvalue()))
-            colorless.write("\n%s" % (" " * header_size))
-        index_current = index_next
+            shown = 0
+            try:
+                for index in store.matching(line_filter):
+                    output.write(render_record(store.record(index))[0])
+                    shown += 1
+            except KeyboardInterrupt:
+                pass
+            output.flush()
+            prompt.write(f"{shown} of {len(store)} lines shown.\n")
 
 
 def usage():
@@ -339,6 +3295,12 @@ def usage():
             -S <device>  Directs command to the device or emulator with the
                          given serial number or qualifier. Overrides
                          ANDROID_SERIAL environment variable.
+            --devices <serial>[,<serial>...]
+                         Follow several devices at once ("all" for every
+                         device attached), in a single stream ordered by
+                         time with a column telling the device of each
+                         line. The "time" format is used unless "threadtime"
+                         is asked.
 
         In both mode you have access to the following options:
             --help / -h  Print this help.
@@ -348,8 +3310,84 @@ def usage():
                          expression.
             -A <regexp>  Show logs which tags or message match the specified
                          regular expression.
+            -K <path>    Show logs which message contains one of the patterns
+                         of a file, one per line: "re:" and a regular
+                         expression, or a literal text. The lines empty or
+                         starting with # are skipped. The patterns are
+                         searched in a single pass, the expression of -M or
+                         -A being one more, and the message of each log
+                         shown starts with the pattern found in it.
+            -L <level>   Show only logs at or above the given level, one of
+                         V, D, I, W, E, F.
+            --since <time> / --until <time>
+                         Show only logs in a time range, <time> being
+                         [MM-DD ]HH:MM[:SS][.fff]. Without a date, the one of
+                         the first dated line of the input is used (today's
+                         for a --file without any).
+                         With --file the start of the range is found by
+                         bisecting the file and the reading stops at its
+                         end, the lines being in time order.
+            --pid <pid>[,<pid>...]
+                         Show only logs of the given processes.
+            --tid <tid>[,<tid>...]
+                         Show only logs of the given threads.
             -i           Ignore case on the regular expression.
             -w <path>    Write output in a file (colorless).
+            -B           Read binary logcat (adb exec-out logcat -B) instead
+                         of text: from adb, stdin or --file. The entries are
+                         decoded without any parsing, with the process and
+                         thread ids and the time to the nanosecond.
+            --file <path>
+                         Read the logs from a file instead of stdin or adb.
+                         The file is memory mapped and each line is only
+                         copied once it passes the filters, which are applied
+                         to batches of lines at once (with numpy when it is
+                         installed).
+            --index      With --file, parse the file once and write a
+                         sidecar index of it (<path>.idx), then exit. The
+                         next runs on the file use the index to only read
+                         the lines that can pass the -T, -L, --pid, --tid,
+                         --since and --until filters. An index that is out
+                         of date or damaged is ignored.
+            -j <jobs>    When the input is a regular file (--file or
+                         redirected from a bugreport), parse and render it
+                         with <jobs> processes. The tag colors then come from
+                         a hash of the tag name so every process agrees on
+                         them.
+            --overflow <policy>
+                         When following adb logcat, what to do once the
+                         <backlog> lines read ahead of the display are all
+                         waiting: "block" the reading (default), drop the
+                         "oldest" line, or drop the new line if its "level"
+                         is below W. The dropped lines are counted in the
+                         output and on exit.
+            --backlog <lines>
+                         Most lines read ahead of the display when following
+                         adb logcat (default 16384).
+            --session    Keep every parsed line in memory, in compact
+                         columns, and once the input ends (or on Ctrl-C when
+                         following a device) prompt on the terminal for new
+                         filters (-T, -M, -A, -L, -i, --pid, --tid, --since,
+                         --until) to show the kept lines again without
+                         reading them anew. An empty filter shows them all.
+            --stats      Only count the lines, by tag, level and process,
+                         without rendering them: the busiest ones over the
+                         last 10 seconds, in lines and bytes per second, are
+                         printed every second, and the whole input on exit.
+                         The filters select the lines counted.
+            --profile    Time each stage of the rendering of the lines (read,
+                         parse, filter, render and each of its fields, write)
+                         and print the time and calls of each stage, the
+                         lines and bytes per second and the peak memory use
+                         on exit and on SIGUSR1. A --file is then read line
+                         by line.
+            --line-buffered
+                         Write each line as soon as it is processed instead
+                         of gathering them in large writes. Default when
+                         the script invokes adb logcat itself.
+            --cache-stats
+                         Print the hit/miss counters of the per tag caches
+                         on exit.
         """
     )
     sys.exit(2)
@@ -365,7 +3403,25 @@ def main():
     re_msg_filter_exp = None
     re_tag_filter = None
     re_msg_filter = None
+    min_level = None
+    pids = None
+    tids = None
+    since = None
+    until = None
+    input_path = None
+    index_mode = False
+    devices = None
     writefile = None
+    cache_stats = False
+    line_buffered = False
+    jobs = 1
+    overflow = "block"
+    backlog = READ_BACKLOG
+    binary = False
+    store = None
+    keywords = None
+    stats = False
+    profiler = None
 
     # adb logcat options
     logcat_option_v = "time"
@@ -374,8 +3430,12 @@ def main():
 
     try:
         opts, arg = getopt.getopt(sys.argv[1:],
-                                  "S:hscit:t:A:T:M:v:w:",
-                                  ["help"])
+                                  "S:hscit:t:A:T:M:K:L:v:w:j:B",
+                                  ["help", "cache-stats",
+                                   "line-buffered", "file=", "index",
+                                   "pid=", "tid=", "since=", "until=",
+                                   "devices=", "overflow=", "backlog=",
+                                   "session", "stats", "profile"])
     except getopt.GetoptError as err:
         print(err)
         print("")
@@ -394,6 +3454,17 @@ def main():
             re_tag_filter_exp = arg
         elif opt == "-M":
             re_msg_filter_exp = arg
+        elif opt == "-K":
+            try:
+                keywords = load_keywords(arg)
+            except OSError as err:
+                print(f"{err}\n")
+                usage()
+        elif opt == "-L":
+            if arg.upper() not in LEVEL_PRIORITY:
+                print("Bad level.\n")
+                usage()
+            min_level = LEVEL_PRIORITY[arg.upper()]
         elif opt == "-v":
             if arg in ("brief", "tag", "thread", "time", "threadtime"):
                 logcat_option_v = arg
@@ -408,18 +3479,126 @@ def main():
             logcat_option.write(" %s%s" % (opt, arg))
         elif opt == "-S":
             adb_option.write(" -s %s" % arg)
+        elif opt == "-B":
+            binary = True
         elif opt == "-w":
             writefile = open(arg, 'a')
+        elif opt == "--file":
+            input_path = arg
+        elif opt == "--devices":
+            devices = arg
+        elif opt == "--index":
+            index_mode = True
+        elif opt in ("--since", "--until"):
+            time_range = parse_time(arg)
+            if time_range is None:
+                print("Bad time.\n")
+                usage()
+            if opt == "--since":
+                since = time_range
+            else:
+                until = time_range
+        elif opt in ("--pid", "--tid"):
+            try:
+                ids = {int(value) for value in arg.split(",")}
+            except ValueError:
+                print("Bad process or thread id.\n")
+                usage()
+            if opt == "--pid":
+                pids = ids
+            else:
+                tids = ids
+        elif opt == "-j":
+            try:
+                jobs = int(arg)
+            except ValueError:
+                jobs = 0
+            if jobs < 1:
+                print("Bad number of jobs.\n")
+                usage()
+        elif opt == "--cache-stats":
+            cache_stats = True
+        elif opt == "--line-buffered":
+            line_buffered = True
+        elif opt == "--overflow":
+            if arg not in OVERFLOW_POLICIES:
+                print("Bad overflow policy.\n")
+                usage()
+            overflow = arg
+        elif opt == "--session":
+            store = RecordStore()
+        elif opt == "--stats":
+            stats = True
+        elif opt == "--profile":
+            profiler = StageProfiler()
+        elif opt == "--backlog":
+            try:
+                backlog = int(arg)
+            except ValueError:
+                backlog = 0
+            if backlog < 1:
+                print("Bad backlog.\n")
+                usage()
+
+    if index_mode:
+        if input_path is None or binary:
+            print("--index needs a text --file.\n")
+            usage()
+        index = build_index(input_path, logcat_option_v)
+        print("Indexed {} lines of {} in {}{}".format(
+            len(index["offsets"]) - 1, input_path, input_path, INDEX_SUFFIX))
+        sys.exit(0)
 
     # If someone is piping in to us, use stdin as input.  if not, invoke
     # adb logcat
-    if os.isatty(sys.stdin.fileno()):
-        input_line = os.popen(
-            "adb{} logcat -v {}{}".format(
-                adb_option.getvalue(),
-                logcat_option_v,
-                logcat_option.getvalue()
-            )
+    if devices is not None and (binary or store is not None or stats):
+        print("-B, --session and --stats cannot follow several devices.\n")
+        usage()
+    if stats and store is not None:
+        print("--session and --stats cannot be used together.\n")
+        usage()
+
+    if devices is not None:
+        # The lines of the devices are merged by date
+        if logcat_option_v not in DATED_FORMATS:
+            logcat_option_v = "time"
+        if devices == "all":
+            devices = list_devices()
+        else:
+            devices = [serial for serial in devices.split(",") if serial]
+        if not devices:
+            print("No device to follow.", file=sys.stderr)
+            sys.exit(1)
+        input_line = None
+    elif input_path is not None and not binary and (
+            store is not None or stats or profiler is not None):
+        # The session keeps every parsed line, the statistics count them and
+        # the profile times each of them: read the file as text
+        input_line = open(input_path, errors="replace")
+    elif input_path is not None:
+        input_line = open(input_path, 'rb')
+    elif binary and os.isatty(sys.stdin.fileno()):
+        # exec-out gives the entries untouched, without the newline
+        # translation of a terminal
+        line_buffered = True
+        input_line = subprocess.Popen(
+            ["adb", *adb_option.getvalue().split(), "exec-out", "logcat",
+             "-B", *logcat_option.getvalue().split()],
+            stdout=subprocess.PIPE
+        ).stdout
+    elif binary:
+        input_line = sys.stdin.buffer
+    elif os.isatty(sys.stdin.fileno()):
+        line_buffered = True
+        input_line = LineRing(
+            os.popen(
+                "adb{} logcat -v {}{}".format(
+                    adb_option.getvalue(),
+                    logcat_option_v,
+                    logcat_option.getvalue()
+                )
+            ),
+            overflow, backlog, logcat_option_v
         )
     else:
         input_line = sys.stdin
@@ -430,119 +3609,201 @@ def main():
         else:
             re_tag_filter = re.compile(re_tag_filter_exp, re_flags)
 
-    if re_msg_filter_exp is not None:
+    if keywords is not None:
+        # The expression of -M or -A is one more pattern
+        if re_msg_filter_exp is not None:
+            keywords.append("re:" + re_msg_filter_exp)
+        try:
+            re_msg_filter = KeywordMatcher(keywords, re_flags or 0)
+        except re.error as err:
+            print(f"Bad keyword pattern: {err}\n")
+            usage()
+    elif re_msg_filter_exp is not None:
         if re_flags is None:
             re_msg_filter = re.compile(re_msg_filter_exp)
         else:
             re_msg_filter = re.compile(re_msg_filter_exp, re_flags)
 
-    while True:
+    output = BatchWriter(sys.stdout, line_buffered)
+    if writefile is not None:
+        writefile = BatchWriter(writefile, line_buffered)
+
+    # Regular files are memory mapped, with --file or to split them between
+    # processes
+    mapped = (input_path is not None and not binary and store is None
+              and not stats and profiler is None)
+    if jobs > 1 and (binary or store is not None or stats
+                     or profiler is not None):
+        print("-j is ignored with -B, --session, --stats and --profile.",
+              file=sys.stderr)
+    elif jobs > 1 and not mapped and input_line is not None:
+        if stat.S_ISREG(os.fstat(input_line.fileno()).st_mode):
+            mapped = True
+        else:
+            print("-j needs a regular file as input, ignored.",
+                  file=sys.stderr)
+
+    # Complete the time range with the date of the file, or today's. The
+    # other inputs are read once, their filter takes the date of their first
+    # dated line.
+    if mapped and any(key is not None and key[0] is None
+                      for key in (since, until)):
+        today = datetime.date.today()
+        first_date = (today.month, today.day)
+        if os.fstat(input_line.fileno()).st_size:
+            with mmap.mmap(input_line.fileno(), 0,
+                           access=mmap.ACCESS_READ) as mapping:
+                found = first_dated_line(
+                    MappedLogcatParser(mapping, logcat_option_v), 0,
+                    len(mapping))
+            if found is not None:
+                first_date = found[0][:2]
+        if since is not None and since[0] is None:
+            since = (*first_date, *since[2:])
+        if until is not None and until[0] is None:
+            until = (*first_date, *until[2:])
+
+    parser = LogcatParser(logcat_option_v)
+    line_filter = None
+    if (re_tag_filter is not None or re_msg_filter is not None
+            or min_level is not None or pids is not None or tids is not None
+            or since is not None or until is not None):
+        filter_class = MappedLineFilter if mapped else LineFilter
+        line_filter = filter_class(re_tag_filter, re_msg_filter, min_level,
+                                   pids, tids, since, until)
+
+    readline = records = None
+    if binary:
+        records = BinaryLogReader(input_line).records()
+    elif input_line is not None:
+        readline = input_line.readline
+    if profiler is not None:
+        # Report on exit, and on demand while following a device
+        signal.signal(signal.SIGUSR1, lambda signum, frame: print(
+            profiler.report(), file=sys.stderr))
+        if binary:
+            records = profiler.records(records)
+        elif readline is not None:
+            readline = profiler.reader(readline)
+        profiler.install(
+            parser, line_filter,
+            [output] if writefile is None else [output, writefile])
+
+    # Narrow the lines to read with the index of the file, if any
+    indexed_lines = None
+    if (mapped and input_path is not None and jobs == 1
+            and line_filter is not None):
+        index = load_index(input_path)
+        if index is not None:
+            indexed_lines = index_lines(index, line_filter)
+
+    if stats:
+        # Count the lines instead of rendering them
+        stats = ThroughputStats(
+            sys.stdout,
+            input_line if isinstance(input_line, LineRing) else None)
         try:
-            line = input_line.readline()
+            if binary:
+                for record in records:
+                    if line_filter is None or line_filter.accept(record):
+                        stats.add(record, len(record.tag) + len(record.msg))
+            else:
+                for line in iter(readline, ""):
+                    record = parser.parse(line)
+                    if (record is None or line_filter is None
+                            or line_filter.accept(record)):
+                        stats.add(record, len(line))
         except KeyboardInterrupt:
-            break
+            pass
+        stats.close()
+        input_line = None
+    elif devices is not None:
+        try:
+            asyncio.run(follow_devices(devices, logcat_option_v,
+                                       logcat_option.getvalue().split(),
+                                       line_filter, output, writefile))
+        except KeyboardInterrupt:
+            pass
+        output.write("\n")
+    elif binary:
+        try:
+            for record in records:
+                if store is not None:
+                    store.append(record)
+                if line_filter is None:
+                    rendered = render_record(record)
+                elif line_filter.accept(record):
+                    rendered = render_record(record,
+                                             pattern=line_filter.pattern)
+                else:
+                    continue
+                output.write(rendered[0])
+                if writefile is not None:
+                    writefile.write(rendered[1])
+        except KeyboardInterrupt:
+            pass
+        output.write("\n")
+        input_line = None
+    elif mapped:
+        try:
+            if indexed_lines is not None:
+                render_indexed(input_line.fileno(), index, indexed_lines,
+                               logcat_option_v, line_filter, output,
+                               writefile)
+            elif jobs > 1:
+                render_parallel(input_line.fileno(), jobs, logcat_option_v,
+                                line_filter, output, writefile)
+            else:
+                render_file(input_line.fileno(), logcat_option_v,
+                            line_filter, output, writefile)
+            # Same end of input as the line by line loop
+            output.write("\n")
+        except KeyboardInterrupt:
+            pass
+        input_line = None
 
-        matchbeginning = rebeginning.match(line)
-        matchthreadtime = rethreadtime.match(line)
-        matchthread = rethread.match(line)
-        matchtime = retime.match(line)
-        matchbrief = rebrief.match(line)
-        matchtag = retag.match(line)
-        linebuf = StringIO()
-        colorless = StringIO()
-        empty_header = StringIO()
-        header_size = 0
-        date = None
-        owner = None
-        thread = None
-        tag_type = None
-        tag = None
-        msg = None
-
-        if matchbeginning is not None:
-            msg, line = matchbeginning.groups()
-            print(
-                "{}{}{}".format(
-                    style_fmt(fgd=WHITE, bgd=BLACK, dim=False),
-                    (f"Beginning of {msg}{line}").center(WIDTH),
-                    style_fmt(reset=True)
-                )
-            )
+    dropped = 0
+    while input_line is not None:
+        try:
+            line = readline()
+        except KeyboardInterrupt:
+            break
 
+        rendered = render_line(line, parser, line_filter, store=store)
+        if rendered is not None:
+            output.write(rendered[0])
             if writefile is not None:
-                writefile.write("Beginning of {msg}{line}".center(WIDTH))
-
-            continue
-
-        if matchthreadtime is not None:
-            *date, owner, thread, tag_type, tag, msg = matchthreadtime.groups()
-
-        elif matchthread is not None:
-            tag_type, owner, thread, msg = matchthread.groups()
-
-        elif matchtime is not None:
-            *date, tag_type, tag, owner, msg = matchtime.groups()
-
-        elif matchbrief is not None:
-            tag_type, tag, owner, msg = matchbrief.groups()
-
-        elif matchtag is not None:
-            tag_type, tag, msg = matchtag.groups()
+                writefile.write(rendered[1])
+        if len(line) == 0:
+            break
 
-        else:
-            print(line)
+        # Tell in the stream when lines were lost
+        if isinstance(input_line, LineRing) and input_line.dropped > dropped:
+            rendered = render_dropped(input_line.dropped - dropped)
+            dropped = input_line.dropped
+            output.write(rendered[0])
             if writefile is not None:
-                writefile.write(line)
-            if len(line) == 0:
-                break
-            continue
+                writefile.write(rendered[1])
 
-        # Print parts
-        if owner is not None:
-            header_size += print_owner(linebuf, colorless, empty_header, owner)
-
-        if thread is not None:
-            header_size += print_thread(linebuf,
-                                        colorless,
-                                        empty_header,
-                                        thread)
-
-        if date is not None:
-            header_size += print_time(linebuf,
-                                      colorless,
-                                      empty_header,
-                                      date)
-
-        if tag is not None:
-            if re_tag_filter is not None:
-                match_tag_filter = re_tag_filter.search(tag)
-            header_size += print_tag(linebuf, colorless, empty_header, tag)
-
-        if tag_type is not None:
-            header_size += print_tag_type(linebuf,
-                                          colorless,
-                                          empty_header,
-                                          tag_type)
+    if store is not None:
+        output.flush()
+        run_session(store, output)
 
-        if msg is not None:
-            if re_msg_filter is not None:
-                match_msg_filter = re_msg_filter.search(msg)
-            print_msg(linebuf, colorless, empty_header, header_size, msg)
+    output.close()
+    if writefile is not None:
+        writefile.close()
 
-        # Filter on the regular expression
-        if re_tag_filter is not None and re_msg_filter is not None:
-            if match_tag_filter is None and match_msg_filter is None:
-                continue
-        elif re_tag_filter is not None:
-            if match_tag_filter is None:
-                continue
-        elif re_msg_filter is not None and match_msg_filter is None:
-            continue
+    if dropped:
+        print(f"Dropped {dropped} lines.", file=sys.stderr)
+
+    if profiler is not None:
+        print(profiler.report(), file=sys.stderr, end="")
 
-        # Actual print
-        print(linebuf.getvalue())
-        if writefile is not None:
-            writefile.write(colorless.getvalue() + '\n')
+    if cache_stats:
+        if line_filter is not None:
+            print(f"Tag filter cache: {line_filter.tag_verdicts.stats()}",
+                  file=sys.stderr)
+        print(f"Tag style cache: {TAG_CACHE.stats()}", file=sys.stderr)
 
 
 if __name__ == '__main__':
@@ -7,13 +7,20 @@
 # The input format will be in the format "[TAG] MESSAGE" by line.
 # The output will add the time of the reception in front of the line and TAG
 # will be colored with a color that won't change for a given 'TAG'.
+# With a format table (-F) the input is instead framed binary records, each
+# one the id of its format string and its packed arguments, printed like the
+# line the format string gives.
 #
 # Written by Hubert Lefevre.
 
-import os, sys, re, StringIO
+import os, sys, re, StringIO, errno, select
 import fcntl, termios, struct
-import datetime
+import datetime, time
+import signal, resource
 import getopt
+import json
+import threading
+import Queue
 import serial
 
 def format(fg = None, bg = None, bright = False, bold = False, dim = False, reset = False):
@@ -38,29 +45,60 @@ def format(fg = None, bg = None, bright = False, bold = False, dim = False, rese
     return "\033[%sm" % (";".join(codes))
 
 def usage():
-    print "cortex_log.py <tty> [-w <nocolor>]"
+    print "cortex_log.py <tty>[,<tty>...] [-w <nocolor>]"
     print " or"
     print "<source> | cortex_log.py [-w <nocolor>]"
     print ""
     print "   <tty> Specify which tty to use, the script will use "\
           "\'/dev/tty<tty>\'"
+    print "         Several ttys separated by commas are read together, "\
+          "their lines interleaved in the order they are received, each "\
+          "one starting with the name of its tty, or with <label> for a "\
+          "<label>=<tty>"
     print "    -T <regexp>     Show only logs which tags that match the "      \
                               "specified regular expression"
     print "    -M <regexp>     Show logs which message match the specified "   \
                               "regular expression"
     print "    -A <regexp>     Show logs which tags or message match the "     \
                               "specified regular expression"
+    print "    -K <path>       Show logs which message contains one of the "  \
+                              "patterns of a file, one per line: 're:' and a " \
+                              "regular expression, or a literal text (empty " \
+                              "lines and lines starting with # skipped). The " \
+                              "message shown starts with the pattern found"
+    print "    -F <path>       Decode framed binary records with the format " \
+                              "strings of a file: a JSON object of the " \
+                              "strings by id, or a dump of the ELF section " \
+                              "of the strings, the id being the offset of " \
+                              "the string. A record is its id (LEB128) and " \
+                              "the arguments of the printf conversions of " \
+                              "the string, little endian: %d and %u 32-bit " \
+                              "(hh, h, ll modifiers), %c one byte, %f 32-bit " \
+                              "(l for 64-bit), %p 32-bit, %s its length " \
+                              "(LEB128) and its bytes. Frames are COBS " \
+                              "encoded and end with a zero byte"
+    print "    --slip          Frames of -F records are SLIP encoded"
     print "    -i              Ignore case on the regular expression"
     print "    -w <path>       Write output in a file (colorless)"
+    print "    -l              Write each line as soon as it is received, "   \
+                              "default when reading a tty"
+    print "    --profile       Time each stage of the processing of the "     \
+                              "lines and print it on exit and on SIGUSR1, "    \
+                              "with the lines and bytes per second and the "   \
+                              "peak memory use"
     sys.exit(2)
 
 
 #############
 # Constants #
 #############
-# Unpack the current terminal width/height
-data = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234')
-HEIGHT, WIDTH = struct.unpack('hh',data)
+# Unpack the current terminal width/height, default size when the output is
+# not a terminal
+try:
+    data = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234')
+    HEIGHT, WIDTH = struct.unpack('hh',data)
+except IOError:
+    HEIGHT, WIDTH = 50, 134
 
 # Colors
 BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
@@ -69,29 +107,85 @@ BLACK, RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE = range(8)
 LAST_USED = [RED, GREEN, YELLOW, BLUE, MAGENTA, CYAN, WHITE]
 KNOWN_TAGS = {}
 
+# Styles, built once instead of on each line
+RESET         = format(reset = True)
+TIME_STYLE    = format(fg = GREEN, bg = BLACK, dim = False)
+TAG_STYLES    = [format(fg = color, dim = False) for color in range(8)]
+MESSAGE_STYLE = format(bg = BLACK, dim = False)
+PORT_STYLES   = [format(fg = BLACK, bg = color, dim = False)
+                 for color in range(8)]
+
+# Colors of the labels of the serial ports, when reading several of them
+PORT_COLORS = [CYAN, MAGENTA, YELLOW, GREEN, BLUE, WHITE, RED]
+
 # Width setting
 TIME_WIDTH  = 19 # Hard coded size of the time format e.g. '08-31 10:55:02.357'
 TAG_WIDTH   = 10
 HEADER_SIZE = TAG_WIDTH + TIME_WIDTH
 
-# Regular expression to match
-rebootline  = re.compile("^\(@\)(.*) (.*)$")
-rerbootline = re.compile("^\r\(@\)(.*) (.*)$")
-rematch     = re.compile("^\[([^\(]+?)\] (.*)$")
-rermatch    = re.compile("^\r\[([^\(]+?)\] (.*)$")
-retagonly   = re.compile("^\[([^\(]+?)\](.*)$")
-rertagonly  = re.compile("^\r\[([^\(]+?)\](.*)$")
-resimple    = re.compile("^([^\(]+)([^\(]+)$")
-rersimple   = re.compile("^\r([^\(]+)([^\(]+)$")
+# Labels of the serial ports and their color, their width, when reading
+# several ports
+PORT_LABELS = {}
+PORT_WIDTH  = 0
+
+# Batched output: size of the pending lines triggering a write, and longest
+# time a line can stay pending (seconds)
+FLUSH_THRESHOLD = 64 * 1024
+FLUSH_INTERVAL  = 0.05
+
+# The main loop waits for the lines received at most READ_POLL seconds at a
+# time, so Ctrl-C is still handled (a Python 2 lock can not be interrupted)
+READ_POLL = 1.0
+
+# Most bytes read from a serial port at once
+SERIAL_CHUNK = 64 * 1024
+
+# Most lines waiting for the main loop, the reading waits beyond them so a
+# slow output does not make the memory grow
+READ_QUEUE_SIZE = 10000
+
+# Date of the second of the last line received, formatted once per second
+TIME_CACHE = [None, None]
+
+# --profile: the stages timed, in the order of the report, the indented ones
+# being part of the previous stage
+PROFILED_STAGES = ("read", "  decode", "parse", "filter", "render",
+                   "  print_port", "  print_time", "  print_tag",
+                   "  print_message", "write", "  flush")
+
+# Framed binary records (-F): delimiter of the frames of each framing, and
+# the SLIP escape byte with the bytes it stands for
+FRAME_DELIMITERS = {"cobs": "\0", "slip": "\xc0"}
+SLIP_ESCAPE      = "\xdb"
+SLIP_ESCAPED     = {"\xdc": "\xc0", "\xdd": "\xdb"}
+
+# printf conversion of a format string: flags, width, precision, length
+# modifier and conversion
+reconversion = re.compile(r"%([-+ #0]*)(\d*)(?:\.(\d*))?(hh|h|ll|l|j|z|t|L)?"
+                          r"([diouxXcspfFeEgG%])")
+
+# Packed type (struct code) of the signed integer of each length modifier,
+# for a 32-bit target, the unsigned one being its upper case
+INTEGER_TYPES = {None: "i", "hh": "b", "h": "h", "l": "i", "ll": "q",
+                 "j": "q", "z": "i", "t": "i"}
 
 # Format function
-def print_time(linebuf, nocolor):
-    linebuf.write("%s%s %s" % (format(fg = GREEN, bg = BLACK, dim = False),
-                               datetime.datetime.now().strftime(
-                                   "%m-%d %H:%M:%S.%f")[:-3],
-                               format(reset = True)))
-    nocolor.write("%s " % (datetime.datetime.now().strftime(
-                               "%m-%d %H:%M:%S.%f")[:-3]))
+def print_port(linebuf, nocolor, port):
+    # Label of the serial port of the line
+    label = port[:PORT_WIDTH].ljust(PORT_WIDTH)
+    linebuf.write("%s%s%s " % (PORT_STYLES[PORT_LABELS[port]], label, RESET))
+    nocolor.write("%s " % (label))
+
+def print_time(linebuf, nocolor, stamp):
+    # Time the line was received, the same for both outputs
+    second = int(stamp)
+    if second != TIME_CACHE[0]:
+        TIME_CACHE[0] = second
+        TIME_CACHE[1] = time.strftime("%m-%d %H:%M:%S",
+                                      time.localtime(second))
+    text = "%s.%03d" % (TIME_CACHE[1], int((stamp - second) * 1000))
+    linebuf.write("%s%s %s" % (TIME_STYLE, text, RESET))
+    nocolor.write("%s " % (text))
 
 def allocate_color(tag):
     # This will allocate a unique format for the given tag
@@ -111,8 +205,7 @@ def print_tag(linebuf, nocolor, tag, bootline = False):
     else:
         color = allocate_color(tag)
     tag = tag[-TAG_WIDTH:].rjust(TAG_WIDTH)
-    linebuf.write("%s%s %s" % (format(fg = color, dim = False), tag,
-                               format(reset = True)))
+    linebuf.write("%s%s %s" % (TAG_STYLES[color], tag, RESET))
     nocolor.write("%s " % (tag))
 
 def print_message(linebuf, nocolor, headersize, message, bootline = False):
@@ -121,12 +214,12 @@ def print_message(linebuf, nocolor, headersize, message, bootline = False):
     current = 0
     while current < len(message):
         next = min(current + wrap_area, len(message))
-        linebuf.write("%s %s %s" % (format(bg = BLACK, dim = False),
-                                    format(reset = True), message[current:next]))
+        linebuf.write("%s %s %s" % (MESSAGE_STYLE, RESET,
+                                    message[current:next]))
         nocolor.write("  %s" % (message[current:next]))
 
         if bootline:
-            linebuf.write("%s " % (format(reset = True)))
+            linebuf.write("%s " % (RESET))
             nocolor.write(" ")
 
         if next < len(message):
@@ -134,6 +227,647 @@ def print_message(linebuf, nocolor, headersize, message, bootline = False):
             nocolor.write("\n%s " % (" " * headersize))
         current = next
 
+def parse_line(line):
+    # Tag, message and whether it is a boot line, None if the line is in none
+    # of the formats:
+    #     "(@)<tag> <message>"  boot line, split on its last space
+    #     "[<tag>] <message>"   the tag ends at the first "] "
+    #     "[<tag>]..."          tag only, the tag ends at the first "]"
+    #     "<message>"           without any "(", its last character dropped
+    # A tag is not empty and has no "(", and the line has no "\n" but its last
+    # character, as read from the port or stdin. A single leading "\r" is
+    # skipped, then the first character tells the formats the line can be in,
+    # each one being parsed with a few linear string searches.
+    if line.startswith("\r"):
+        text = line[1:]
+    else:
+        text = line
+    if text.endswith("\n"):
+        end = len(text) - 1
+    else:
+        end = len(text)
+
+    first = text[:1]
+    if first == "(":
+        if text.startswith("(@)"):
+            tag, space, message = text[3:end].rpartition(" ")
+            if space:
+                return tag, message, True
+        return None
+
+    if first == "[":
+        close = text.find("] ", 2)
+        if close >= 0 and text.find("(", 1, close) < 0:
+            return text[1:close], text[close + 2:end], False
+        close = text.find("]", 2)
+        if close >= 0 and text.find("(", 1, close) < 0:
+            return text[1:close], " ", False
+
+    if text.find("(") >= 0:
+        return None
+    if len(text) >= 2:
+        return " ", text[:-1], False
+    if len(line) >= 2:
+        # "\r" and a single character, the "\r" being the message
+        return " ", line[:-1], False
+    return None
+
+def filter_line(tag, message):
+    # Whether the line is shown, and the pattern of the keyword file found in
+    # its message
+    if not reTagFilter is None:
+        matchTagFilter = reTagFilter.search(tag)
+
+    if not reMsgFilter is None:
+        matchMsgFilter = reMsgFilter.search(message)
+
+    if not reTagFilter is None and not reMsgFilter is None:
+        if matchTagFilter is None and matchMsgFilter is None:
+            return False, None
+    elif not reTagFilter is None:
+        if matchTagFilter is None:
+            return False, None
+    elif not reMsgFilter is None and matchMsgFilter is None:
+        return False, None
+
+    if keywords is None or reMsgFilter is None:
+        return True, None
+    return True, matchMsgFilter
+
+def render_line(tag, message, isbootline, stamp, port = None):
+    # Colored and colorless texts of a line
+    linebuf = StringIO.StringIO()
+    nocolor = StringIO.StringIO()
+
+    if not port is None:
+        print_port(linebuf, nocolor, port)
+    print_time(linebuf, nocolor, stamp)
+    print_tag(linebuf, nocolor, tag, isbootline)
+    print_message(linebuf, nocolor, HEADER_SIZE, message, isbootline)
+    return linebuf.getvalue() + "\n", nocolor.getvalue() + "\n"
+
+def required_literal(expression):
+    # Longest literal text every match of the regular expression contains,
+    # from the plain characters outside of groups, classes and repetitions.
+    # None if there is none.
+    if re.search(r"\(\?[aiLmsux]", expression):
+        # Inline flags may change what is required
+        return None
+    runs  = []
+    run   = []
+    index = 0
+    while index < len(expression):
+        char   = expression[index]
+        index += 1
+        if char == "\\":
+            escaped = expression[index:index + 1]
+            index  += 1
+            if escaped and not escaped.isalnum():
+                run.append(escaped)
+                continue
+        elif char == "[":
+            # Skip the class, a leading ] or ^] being part of it
+            if expression[index:index + 1] == "^":
+                index += 1
+            if expression[index:index + 1] == "]":
+                index += 1
+            while index < len(expression) and expression[index] != "]":
+                index += 2 if expression[index] == "\\" else 1
+            index += 1
+        elif char == "(":
+            depth = 1
+            while index < len(expression) and depth:
+                if expression[index] == "\\":
+                    index += 1
+                elif expression[index] == "(":
+                    depth += 1
+                elif expression[index] == ")":
+                    depth -= 1
+                index += 1
+        elif char in "*?{":
+            # The repeated character may be absent
+            if run:
+                run.pop()
+            if char == "{":
+                index = expression.find("}", index) + 1 or len(expression)
+        elif char == "|":
+            # Nothing is required by every alternative
+            return None
+        elif not char in ".^$+":
+            run.append(char)
+            continue
+        runs.append("".join(run))
+        run = []
+    runs.append("".join(run))
+    return max(runs, key = len) or None
+
+def trie_pattern(words):
+    # Regular expression matching any of the words, their common prefixes
+    # factored in a trie so each position is checked in one pass
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def branch(node):
+        alternatives = [re.escape(char) + branch(child)
+                        for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ""
+        if "" in node:
+            return "(?:%s)?" % ("|".join(alternatives))
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:%s)" % ("|".join(alternatives))
+
+    return branch(trie)
+
+class KeywordMatcher(object):
+    # Search many literal keywords and regular expressions at once. The
+    # literals, and the literal each regular expression requires, are merged
+    # in a trie compiled to a single regular expression, so a message is
+    # scanned once whatever the number of patterns, like with an Aho-Corasick
+    # automaton. A regular expression only runs on the messages where its
+    # literal was found, or on all of them when it has none.
+    # search() returns the pattern found, None if there is none.
+    def __init__(self, patterns, flags = 0):
+        self.patterns   = patterns
+        self.fold       = bool(flags & re.IGNORECASE)
+        self.unanchored = []
+        triggers        = {}
+        for pattern in patterns:
+            if pattern.startswith("re:"):
+                regex = re.compile(pattern[3:], flags)
+                word  = required_literal(pattern[3:])
+                if word is None:
+                    self.unanchored.append((pattern, regex))
+                    continue
+            else:
+                regex = None
+                word  = pattern
+            if self.fold:
+                word = word.lower()
+            triggers.setdefault(word, []).append((pattern, regex))
+
+        # The trie matches the longest word at a position, the shorter ones
+        # found there are its prefixes
+        self.candidates = {}
+        for word in triggers:
+            self.candidates[word] = [candidate
+                                     for length in range(1, len(word) + 1)
+                                     for candidate in
+                                         triggers.get(word[:length], ())]
+        self.trie = None
+        if triggers:
+            self.trie = re.compile(trie_pattern(triggers), flags)
+
+    def search(self, text):
+        if not self.trie is None:
+            failed   = set()
+            position = 0
+            while True:
+                match = self.trie.search(text, position)
+                if match is None:
+                    break
+                word = match.group()
+                if self.fold:
+                    word = word.lower()
+                for pattern, regex in self.candidates[word]:
+                    if regex is None:
+                        return pattern
+                    if not pattern in failed:
+                        if regex.search(text):
+                            return pattern
+                        failed.add(pattern)
+                position = match.start() + 1
+
+        for pattern, regex in self.unanchored:
+            if regex.search(text):
+                return pattern
+        return None
+
+class StageProfiler(object):
+    # Cumulative time and calls of each stage of the processing of the lines.
+    # The stages are timed by wrapping the functions doing them, so nothing
+    # is added when not profiling. The reading also counts the lines and
+    # bytes of the input. Python 2 has no monotonic clock, the wall clock is
+    # used.
+    def __init__(self):
+        self.stages  = dict((stage.strip(), [0, 0.0])
+                            for stage in PROFILED_STAGES)
+        self.lines   = 0
+        self.bytes   = 0
+        self.started = time.time()
+
+    def timed(self, stage, func):
+        counters = self.stages[stage]
+        clock    = time.time
+
+        def timed_func(*args, **kwargs):
+            start        = clock()
+            result       = func(*args, **kwargs)
+            counters[0] += 1
+            counters[1] += clock() - start
+            return result
+        return timed_func
+
+    def reader(self, readlines):
+        readlines = self.timed("read", readlines)
+
+        def counted_readlines():
+            lines       = readlines()
+            self.lines += len(lines)
+            self.bytes += sum(len(line) for _, _, line in lines)
+            return lines
+        return counted_readlines
+
+    def report(self):
+        elapsed = max(time.time() - self.started, 1e-6)
+        peak    = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        text    = StringIO.StringIO()
+        text.write("Profile of %.3f s: %d lines, %.0f lines/s, %.0f bytes/s, "
+                   "peak RSS %.1f MiB\n" % (elapsed, self.lines,
+                                            self.lines / elapsed,
+                                            self.bytes / elapsed,
+                                            peak / 1024.0))
+        text.write("%-18s %10s %10s %10s %6s\n" % ("stage", "calls",
+                                                   "total s", "us/call",
+                                                   "share"))
+        for stage in PROFILED_STAGES:
+            calls, seconds = self.stages[stage.strip()]
+            if not calls:
+                continue
+            text.write("%-18s %10d %10.3f %10.2f %5.1f%%\n" % (
+                stage, calls, seconds, 1e6 * seconds / calls,
+                100 * seconds / elapsed))
+        return text.getvalue()
+
+    def print_report(self, signum = None, frame = None):
+        sys.stderr.write(self.report())
+
+def read_varint(data, offset):
+    # Unsigned LEB128 number of the bytearray at the offset, and the offset
+    # after it
+    value = 0
+    shift = 0
+    while True:
+        if offset >= len(data):
+            raise ValueError("truncated number")
+        byte    = data[offset]
+        offset += 1
+        value  |= (byte & 0x7f) << shift
+        shift  += 7
+        if byte < 0x80:
+            return value, offset
+
+def cobs_decode(frame):
+    # Bytes of a COBS frame without its delimiter: each block starts with
+    # its length plus one, the block ending with a zero byte unless it is
+    # the longest one (0xff) or the last one
+    data   = bytearray()
+    offset = 0
+    while offset < len(frame):
+        code = frame[offset]
+        end  = offset + code
+        if code == 0 or end > len(frame):
+            raise ValueError("bad COBS block")
+        data  += frame[offset + 1:end]
+        offset = end
+        if code < 0xff and offset < len(frame):
+            data.append(0)
+    return data
+
+def slip_decode(frame):
+    # Bytes of a SLIP frame without its delimiter, each escape byte being
+    # followed by the code of the byte it stands for
+    parts = str(frame).split(SLIP_ESCAPE)
+    data  = bytearray(parts[0])
+    for part in parts[1:]:
+        if not part[:1] in SLIP_ESCAPED:
+            raise ValueError("bad SLIP escape")
+        data += SLIP_ESCAPED[part[0]]
+        data += part[1:]
+    return data
+
+def load_formats(path):
+    # Format strings of -F by id, from a JSON object of the strings by id
+    # (decimal, or hexadecimal starting with 0x), or from a dump of the ELF
+    # section of the strings, each one ending with a zero byte, the id being
+    # its offset in the section
+    data    = open(path, "rb").read()
+    formats = {}
+    if data.lstrip()[:1] == "{":
+        for key, text in json.loads(data).items():
+            formats[int(key, 0)] = text.encode("utf-8")
+        return formats
+    offset = 0
+    for text in data.split("\0"):
+        if text:
+            formats[offset] = text
+        offset += len(text) + 1
+    return formats
+
+def compile_format(text):
+    # Python format of a format string, and the fields of its packed
+    # arguments: a struct for each run of numbers, None for a string
+    pieces = []
+    codes  = []
+    start  = 0
+    for match in reconversion.finditer(text):
+        literal = text[start:match.start()]
+        if "%" in literal:
+            raise ValueError("unsupported conversion in %r" % (text))
+        pieces.append(literal)
+        start = match.end()
+        flags, width, precision, length, conversion = match.groups()
+        if conversion == "%":
+            pieces.append("%%")
+            continue
+        if conversion == "s":
+            codes.append(None)
+        elif conversion == "p":
+            codes.append("I")
+            pieces.append("0x%08x")
+            continue
+        elif conversion == "c":
+            codes.append("B")
+        elif conversion in "fFeEgG":
+            codes.append("d" if length in ("l", "L") else "f")
+        elif length in INTEGER_TYPES:
+            code = INTEGER_TYPES[length]
+            if conversion in "ouxX":
+                code = code.upper()
+            codes.append(code)
+        else:
+            raise ValueError("unsupported conversion in %r" % (text))
+        if conversion == "i":
+            conversion = "d"
+        if precision is None:
+            pieces.append("%%%s%s%s" % (flags, width, conversion))
+        else:
+            pieces.append("%%%s%s.%s%s" % (flags, width, precision,
+                                           conversion))
+    literal = text[start:]
+    if "%" in literal:
+        raise ValueError("unsupported conversion in %r" % (text))
+    pieces.append(literal)
+
+    fields = []
+    run    = ""
+    for code in codes + [None]:
+        if not code is None:
+            run += code
+            continue
+        if run:
+            fields.append(struct.Struct("<" + run))
+            run = ""
+        fields.append(None)
+    return "".join(pieces), fields[:-1]
+
+class FrameDecoder(object):
+    # Decode the framed binary records of -F to the lines the firmware would
+    # have printed: the record of a frame is the id of its format string and
+    # the arguments of the string packed little endian. The format strings
+    # are compiled the first time they are used. A frame that can not be
+    # decoded gives a "(bad frame...)" line, printed as is.
+    def __init__(self, formats, framing = "cobs"):
+        self.formats   = formats
+        self.compiled  = {}
+        self.delimiter = FRAME_DELIMITERS[framing]
+        if framing == "cobs":
+            self.unframe = cobs_decode
+        else:
+            self.unframe = slip_decode
+
+    def decode(self, frame):
+        # Line of a frame without its delimiter
+        try:
+            record        = self.unframe(bytearray(frame))
+            ident, offset = read_varint(record, 0)
+            if not ident in self.compiled:
+                if not ident in self.formats:
+                    raise ValueError("unknown format id %d" % (ident))
+                self.compiled[ident] = compile_format(self.formats[ident])
+            text, fields = self.compiled[ident]
+
+            args = []
+            for field in fields:
+                if field is None:
+                    length, offset = read_varint(record, offset)
+                    if offset + length > len(record):
+                        raise ValueError("truncated string")
+                    args.append(str(record[offset:offset + length]))
+                    offset += length
+                else:
+                    args.extend(field.unpack_from(record, offset))
+                    offset += field.size
+            if offset != len(record):
+                raise ValueError("%d bytes left" % (len(record) - offset))
+            line = text % tuple(args)
+        except (ValueError, struct.error) as err:
+            return "(bad frame: %s: %s)\n" % (err, str(frame).encode("hex"))
+        # One line, whatever the format string and the strings give
+        return line.rstrip("\r\n").replace("\n", " ") + "\n"
+
+def stream_lines(stream):
+    # Read function of a LineReader for a file: its next line, stamped, in a
+    # list
+    def readlines():
+        line = stream.readline()
+        if len(line) == 0:
+            return []
+        return [(time.time(), None, line)]
+    return readlines
+
+def stream_frames(stream, decoder):
+    # Read function of a LineReader for a file of framed binary records: the
+    # lines of the frames completed by the next chunk read, stamped. A last
+    # frame without its delimiter is decoded at the end of the file.
+    buf = bytearray()
+
+    def readlines():
+        while True:
+            data = os.read(stream.fileno(), SERIAL_CHUNK)
+            if len(data) == 0:
+                frames = [str(buf)]
+                del buf[:]
+            else:
+                start = len(buf)
+                buf.extend(data)
+                end = buf.rfind(decoder.delimiter, start)
+                if end < 0:
+                    continue
+                frames = str(buf[:end]).split(decoder.delimiter)
+                del buf[:end + 1]
+            stamp = time.time()
+            lines = [(stamp, None, decoder.decode(frame))
+                     for frame in frames if frame]
+            if lines or len(data) == 0:
+                return lines
+    return readlines
+
+class SerialLines(object):
+    # Read function of a LineReader for serial ports: whatever a port
+    # received, in one read of up to SERIAL_CHUNK bytes once select() tells
+    # it is readable, instead of the byte by byte reads of its readline().
+    # Each read is stamped, so the lines of all the ports come in the order
+    # they were received. The bytes wait in a bytearray of their port until
+    # their line is complete, the lines being split on "\n" like readline()
+    # does, so the "\r" of a "\n\r" end of line starts the next line where
+    # parse_line() skips it. With a FrameDecoder the bytes are split in
+    # frames on its delimiter instead, each frame giving a line, the empty
+    # ones being skipped. The first line of each port, cut by the start of
+    # the reading, is dropped. A port failing is closed and the other ones
+    # are still read.
+    def __init__(self, ports, decoder = None):
+        # Label (None for a single port) and Serial of each port
+        self.ports   = dict((port.fileno(), [label, port, bytearray(), True])
+                            for label, port in ports)
+        self.decoder = decoder
+        if decoder is None:
+            self.separator = "\n"
+        else:
+            self.separator = decoder.delimiter
+
+    def readlines(self):
+        while self.ports:
+            try:
+                readable, _, _ = select.select(self.ports.keys(), [], [])
+            except select.error as err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            lines = []
+            for fd in readable:
+                label, port, buf, first = self.ports[fd]
+                try:
+                    data = os.read(fd, SERIAL_CHUNK)
+                except OSError as err:
+                    if err.errno in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    sys.stderr.write("%s: %s\n" % (port.port, err))
+                    data = ""
+                stamp = time.time()
+                if len(data) == 0:
+                    # The port is gone
+                    del self.ports[fd]
+                    port.close()
+                    continue
+
+                start = len(buf)
+                buf  += data
+                end   = buf.rfind(self.separator, start)
+                if end < 0:
+                    continue
+                received = str(buf[:end]).split(self.separator)
+                del buf[:end + 1]
+                if first:
+                    self.ports[fd][3] = False
+                    received = received[1:]
+                if self.decoder is None:
+                    lines.extend((stamp, label, line + "\n")
+                                 for line in received)
+                else:
+                    lines.extend((stamp, label, self.decoder.decode(frame))
+                                 for frame in received if frame)
+            if lines:
+                return lines
+        return []
+
+class LineReader(object):
+    # Read the lines of the source from a thread, the read function stamping
+    # them with a single clock sample as soon as they are received, before
+    # any parsing or rendering. The stamped lines wait in a queue for the
+    # main loop, the end of the source being an empty line. The queue holds
+    # at most READ_QUEUE_SIZE lines, the thread waiting when the main loop
+    # falls behind. Python 2 has no monotonic clock, the stamps come from
+    # time.time().
+    def __init__(self, readlines):
+        self.readlines     = readlines
+        self.queue         = Queue.Queue(READ_QUEUE_SIZE)
+        self.thread        = threading.Thread(target = self.reader)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reader(self):
+        while True:
+            try:
+                lines = self.readlines()
+            except (IOError, OSError, serial.SerialException) as err:
+                sys.stderr.write("%s\n" % (err))
+                lines = []
+            for line in lines:
+                self.queue.put(line)
+            if len(lines) == 0:
+                self.queue.put((time.time(), None, ""))
+                break
+
+    def get(self):
+        # Time the line was received, label of its port and the line
+        while True:
+            try:
+                return self.queue.get(True, READ_POLL)
+            except Queue.Empty:
+                pass
+
+class BatchWriter(object):
+    # Gather the lines and write them in large chunks, once they reach
+    # FLUSH_THRESHOLD characters or FLUSH_INTERVAL after the first one.
+    # In line mode each line is written and flushed right away.
+    def __init__(self, stream, linemode = False):
+        self.stream   = stream
+        self.linemode = linemode
+        self.pending  = []
+        self.size     = 0
+        self.closed   = False
+        self.cond     = threading.Condition()
+        self.thread   = None
+        if not linemode:
+            self.thread        = threading.Thread(target = self.timer)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def write(self, text):
+        if self.linemode:
+            self.stream.write(text)
+            self.stream.flush()
+            return
+        with self.cond:
+            if not self.pending:
+                self.cond.notify()
+            self.pending.append(text)
+            self.size += len(text)
+            if self.size >= FLUSH_THRESHOLD:
+                self.flush_pending()
+
+    def flush_pending(self):
+        # Lock must be held
+        if self.pending:
+            self.stream.write("".join(self.pending))
+            self.stream.flush()
+            self.pending = []
+            self.size    = 0
+
+    def timer(self):
+        with self.cond:
+            while not self.closed:
+                if not self.pending:
+                    self.cond.wait()
+                    continue
+                self.cond.wait(FLUSH_INTERVAL)
+                self.flush_pending()
+
+    def close(self):
+        with self.cond:
+            self.flush_pending()
+            self.closed = True
+            self.cond.notify()
+        if not self.thread is None:
+            self.thread.join()
+
 ########
 # Main #
 ########
@@ -144,42 +878,63 @@ reTagFilterExp = None
 reMsgFilterExp = None
 reTagFilter    = None
 reMsgFilter    = None
+keywords       = None
+formatsPath    = None
+framing        = "cobs"
+decoder        = None
 writefile      = None
+linemode       = False
+profiler       = None
 
 # If someone is piping in to us, use stdin as input, otherwise use first
-# argument to know which tty you should open
+# argument to know which ttys you should open
+ports = []
 if os.isatty(sys.stdin.fileno()):
     if len(sys.argv) < 2:
         usage()
-    source              = serial.Serial()
-    source.port         = "/dev/tty%s" % sys.argv[1]
-    ########################
-    # Serial configuration #
-    ########################
-    source.baudrate     = 115200
-    source.bytesize     = serial.EIGHTBITS
-    source.parity       = serial.PARITY_NONE
-    source.stopbits     = serial.STOPBITS_ONE
-    source.timeout      = 0     # Non-Block reading
-    source.xonxoff      = False # Disable Software Flow Control
-    source.rtscts       = False # Disable (RTS/CTS) flow Control
-    source.dsrdtr       = False # Disable (DSR/DTR) flow Control
-    source.timeout      = None  # Wait forever
-    source.writeTimeout = 2
-    try:
-        source.open()
-    except serial.SerialException as err:
-        print str(err)
-        print ""
-        usage()
-    source.flushInput()
-    source.flushOutput()
+    linemode = True
+    for name in sys.argv[1].split(","):
+        label, _, name      = name.rpartition("=")
+        source              = serial.Serial()
+        source.port         = "/dev/tty%s" % name
+        ########################
+        # Serial configuration #
+        ########################
+        source.baudrate     = 115200
+        source.bytesize     = serial.EIGHTBITS
+        source.parity       = serial.PARITY_NONE
+        source.stopbits     = serial.STOPBITS_ONE
+        source.timeout      = 0     # Non-Block reading
+        source.xonxoff      = False # Disable Software Flow Control
+        source.rtscts       = False # Disable (RTS/CTS) flow Control
+        source.dsrdtr       = False # Disable (DSR/DTR) flow Control
+        source.timeout      = None  # Wait forever
+        source.writeTimeout = 2
+        try:
+            source.open()
+        except serial.SerialException as err:
+            print str(err)
+            print ""
+            usage()
+        source.flushInput()
+        source.flushOutput()
+        ports.append((label or name, source))
+
+    if len(ports) == 1:
+        # No label column for a single port
+        ports = [(None, source)]
+    else:
+        for index, (label, _) in enumerate(ports):
+            PORT_LABELS[label] = PORT_COLORS[index % len(PORT_COLORS)]
+        PORT_WIDTH   = max(len(label) for label, _ in ports)
+        HEADER_SIZE += PORT_WIDTH + 1
 else:
     source = sys.stdin
 
 # Handle options
 try:
-    opts, arg = getopt.getopt(sys.argv[2:], "hw:iA:T:M:", ["help"])
+    opts, arg = getopt.getopt(sys.argv[2:], "hw:ilA:T:M:K:F:",
+                               ["help", "profile", "slip"])
 except getopt.GetoptError as err:
     print str(err)
     print ""
@@ -191,6 +946,14 @@ for o, a in opts:
         usage()
     elif o == "-i":
         reFlags = re.IGNORECASE
+    elif o == "-l":
+        linemode = True
+    elif o == "--profile":
+        profiler = StageProfiler()
+    elif o == "--slip":
+        framing = "slip"
+    elif o == "-F":
+        formatsPath = a
     elif o == "-A":
         reTagFilterExp = a
         reMsgFilterExp = a
@@ -198,6 +961,14 @@ for o, a in opts:
         reTagFilterExp = a
     elif o == "-M":
         reMsgFilterExp = a
+    elif o == "-K":
+        try:
+            keywords = [line for line in open(a).read().splitlines()
+                        if line and not line.startswith("#")]
+        except IOError as err:
+            print str(err)
+            print ""
+            usage()
     elif o == "-w":
         writefile = open(a, 'a')
         if not writefile is None:
@@ -214,90 +985,114 @@ if not reTagFilterExp is None:
     else:
         reTagFilter = re.compile(reTagFilterExp, reFlags)
 
-if not reMsgFilterExp is None:
+if not keywords is None:
+    # The expression of -M or -A is one more pattern
+    if not reMsgFilterExp is None:
+        keywords.append("re:" + reMsgFilterExp)
+    try:
+        reMsgFilter = KeywordMatcher(keywords, reFlags or 0)
+    except re.error as err:
+        print "Bad keyword pattern: %s" % (err)
+        print ""
+        usage()
+elif not reMsgFilterExp is None:
     if reFlags is None:
         reMsgFilter = re.compile(reMsgFilterExp)
     else:
         reMsgFilter = re.compile(reMsgFilterExp, reFlags)
 
+# Load the format strings of the framed binary records
+if not formatsPath is None:
+    try:
+        decoder = FrameDecoder(load_formats(formatsPath), framing)
+    except (IOError, ValueError) as err:
+        print "Bad format table: %s" % (err)
+        print ""
+        usage()
+
+output = BatchWriter(sys.stdout, linemode)
+if not writefile is None:
+    writefile = BatchWriter(writefile, linemode)
+
+if ports:
+    readlines = SerialLines(ports, decoder).readlines
+elif decoder is None:
+    readlines = stream_lines(source)
+else:
+    readlines = stream_frames(source, decoder)
+if not profiler is None:
+    # Report on exit, and on demand while reading a tty, without
+    # interrupting the reading
+    signal.signal(signal.SIGUSR1, profiler.print_report)
+    signal.siginterrupt(signal.SIGUSR1, False)
+    readlines = profiler.reader(readlines)
+    if not decoder is None:
+        decoder.decode = profiler.timed("decode", decoder.decode)
+    for writer in (output, writefile):
+        if not writer is None:
+            writer.write         = profiler.timed("write", writer.write)
+            writer.flush_pending = profiler.timed("flush",
+                                                  writer.flush_pending)
+    parse_line    = profiler.timed("parse", parse_line)
+    filter_line   = profiler.timed("filter", filter_line)
+    render_line   = profiler.timed("render", render_line)
+    print_port    = profiler.timed("print_port", print_port)
+    print_time    = profiler.timed("print_time", print_time)
+    print_tag     = profiler.timed("print_tag", print_tag)
+    print_message = profiler.timed("print_message", print_message)
+
 # Set terminal name so you know the argument used
 sys.stdout.write("\x1b]2;cortex_log %s\x07" % ' '.join(sys.argv[1:]))
 
-# Flush first line
-try:
-    line = source.readline()
-except KeyboardInterrupt:
-    exit
+# Flush first line, the serial ports drop their own, the frames of a file are
+# all whole
+if not ports and decoder is None:
+    try:
+        line = source.readline()
+    except KeyboardInterrupt:
+        exit
+
+reader = LineReader(readlines)
 
 # Main loop
 while True:
     try:
-        line = source.readline()
+        stamp, port, line = reader.get()
     except KeyboardInterrupt:
         break
 
-    isbootline = False
-    bootline = rebootline.match(line)
-    if bootline is None:
-        bootline = rerbootline.match(line)
-
-    match = rermatch.match(line)
-    if match is None:
-        match = rematch.match(line)
-
-    tagonly = rertagonly.match(line)
-    if tagonly is None:
-        tagonly = retagonly.match(line)
-
-    simple = rersimple.match(line)
-    if simple is None:
-        simple = resimple.match(line)
-
-    if not bootline is None:
-        tag, message = bootline.groups()
-        isbootline   = True
-
-    elif not match is None:
-        tag, message = match.groups()
-
-    elif not tagonly is None:
-        tag, uu = tagonly.groups()
-        message = " "
-
-    elif not simple is None:
-        message, uu = simple.groups()
-        tag         = " "
-
-    elif len(line) == 0:
-        break;
-
-    else:
-        print(line)
+    parsed = parse_line(line)
+    if parsed is None:
+        if len(line) == 0:
+            break
+        if not port is None:
+            label = port[:PORT_WIDTH].ljust(PORT_WIDTH)
+            output.write("%s%s%s " % (PORT_STYLES[PORT_LABELS[port]], label,
+                                      RESET))
+            if not writefile is None:
+                writefile.write("%s " % (label))
+        output.write(line + "\n")
         if not writefile is None:
             writefile.write(line)
         continue
+    tag, message, isbootline = parsed
 
-    if not reTagFilter is None:
-        matchTagFilter = reTagFilter.search(tag)
-
-    if not reMsgFilter is None:
-        matchMsgFilter = reMsgFilter.search(message)
-
-    if not reTagFilter is None and not reMsgFilter is None:
-        if matchTagFilter is None and matchMsgFilter is None:
-            continue
-    elif not reTagFilter is None:
-        if matchTagFilter is None:
-            continue
-    elif not reMsgFilter is None and matchMsgFilter is None:
+    shown, pattern = filter_line(tag, message)
+    if not shown:
         continue
 
-    linebuf = StringIO.StringIO()
-    nocolor = StringIO.StringIO()
+    # Tell which pattern of the keyword file was found
+    if not pattern is None:
+        message = "[%s] %s" % (pattern, message)
 
-    print_time(linebuf, nocolor)
-    print_tag(linebuf, nocolor, tag, isbootline)
-    print_message(linebuf, nocolor, HEADER_SIZE, message, isbootline)
-    print linebuf.getvalue()
+    colored, colorless = render_line(tag, message, isbootline, stamp, port)
+    output.write(colored)
     if not writefile is None:
-        writefile.write(nocolor.getvalue() + '\n');
+        writefile.write(colorless)
+
+output.close()
+if not writefile is None:
+    writefile.close()
+
+if not profiler is None:
+    profiler.print_report()
@@ -0,0 +1,543 @@
+#!/usr/bin/python3.8
+
+'''
+    Benchmark of adb_logcat.py and cortex_log.py on synthetic logs.
+
+    The logs are generated from a seed, so two runs with the same options
+    process the same lines and their results can be compared.
+'''
+
+import os
+import sys
+import re
+import time
+import json
+import random
+import getopt
+import tempfile
+import tracemalloc
+import subprocess
+import importlib.util
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ADB_LOGCAT = os.path.join(SCRIPT_DIR, "adb_logcat.py")
+CORTEX_LOG = os.path.join(SCRIPT_DIR, "cortex_log.py")
+
+# Formats generated for adb_logcat.py, and the cortex_log.py one
+ADB_FORMATS = ("brief", "tag", "thread", "time", "threadtime")
+CORTEX_FORMAT = "cortex"
+
+# Default size of the logs, and number of runs of which the best is kept
+LINES = 100000
+REPEATS = 3
+SEED = 1
+
+# Lowest lines/s, relative to the baseline, before a benchmark is reported
+# as a regression
+REGRESSION_THRESHOLD = 0.9
+
+# What the lines are made of: tags and their weight, levels and their weight,
+# number of processes and most threads per process
+TAGS = (("ActivityManager", 8), ("PackageManager", 3), ("SurfaceFlinger", 6),
+        ("WindowManager", 5), ("chatty", 2), ("art", 4), ("InputReader", 3),
+        ("BluetoothAdapter", 2), ("wpa_supplicant", 3), ("AudioFlinger", 4),
+        ("System.err", 1), ("CameraService", 2), ("libc", 1), ("Zygote", 1),
+        ("NetworkMonitor/100", 2), ("ConnectivityService", 2),
+        ("OpenGLRenderer", 3), ("vold", 1))
+LEVELS = (("V", 10), ("D", 35), ("I", 35), ("W", 12), ("E", 7), ("F", 1))
+PROCESSES = 40
+THREADS = 8
+
+# Messages: most are short, some are long enough to be wrapped on several
+# lines, and some contain wide characters
+MESSAGES = ("Displayed com.example.app/.MainActivity: +{n}ms",
+            "Start proc {n}:com.example.service/u0a{n2} for service",
+            "GC freed {n}KB AllocSpace objects, {n2}% free, {n3}MB/{n}MB",
+            "setPowerMode(0x{h}, {n2}) called",
+            "Connection state changed to {n2} (0x{h})",
+            "Timeout waiting for {n}ms, retrying",
+            "onResume() of ActivityRecord{{{h} u0 t{n2}}}",
+            "Skipped {n2} frames! The application may be doing too much work",
+            "écran allumé, luminosité {n2}%",
+            "接続が確立されました ({n2} ms)")
+LONG_MESSAGE_RATIO = 0.05
+LONG_MESSAGE = ("java.lang.IllegalStateException: {h} at com.example.app."
+                "Controller.update(Controller.java:{n2}) at com.example.app."
+                "Controller.access$000(Controller.java:{n3}) at android.os."
+                "Handler.handleCallback(Handler.java:{n}) ")
+
+# "beginning of" banners: probability of a buffer switch per line
+BANNER_RATIO = 0.001
+BUFFERS = ("main", "system", "crash", "events", "radio")
+
+# cortex_log.py lines: weight of the "[TAG] msg", "[TAG]", "(@)" boot and
+# untagged lines, and probability of a leading carriage return
+CORTEX_KINDS = (("tagged", 80), ("tagonly", 5), ("boot", 5), ("simple", 10))
+CORTEX_TAGS = ("BLE", "ADC", "SPI", "I2C", "PWR", "RTC", "UART", "SENSOR",
+               "DMA", "FLASH", "USB", "MAIN")
+CR_RATIO = 0.1
+
+# Benchmarks run end to end: name, script, format of the log, options
+END_TO_END = tuple(
+    (f"adb {logcat_format}", ADB_LOGCAT, logcat_format, ["-v", logcat_format])
+    for logcat_format in ADB_FORMATS
+) + (
+    ("adb threadtime -T", ADB_LOGCAT, "threadtime",
+     ["-v", "threadtime", "-T", "Manager"]),
+    ("adb threadtime -L E", ADB_LOGCAT, "threadtime",
+     ["-v", "threadtime", "-L", "E"]),
+    ("adb threadtime --file", ADB_LOGCAT, "threadtime",
+     ["-v", "threadtime", "--file", None]),
+    ("adb threadtime --file -T", ADB_LOGCAT, "threadtime",
+     ["-v", "threadtime", "-T", "Manager", "--file", None]),
+    ("adb threadtime --stats", ADB_LOGCAT, "threadtime",
+     ["-v", "threadtime", "--stats"]),
+    ("cortex", CORTEX_LOG, CORTEX_FORMAT, ["-"]),
+    ("cortex -T", CORTEX_LOG, CORTEX_FORMAT, ["-", "-T", "BLE|ADC"]),
+)
+
+# Line of a stage in the --profile report of the scripts
+reprofilestage = re.compile(r"^ *(\w+) +(\d+) +([\d.]+) +([\d.]+) +[\d.]+%$")
+
+
+class LogGenerator:
+    """
+    @brief Synthetic log lines, the same ones for the same seed.
+    """
+
+    def __init__(self, seed=SEED):
+        """
+        @brief
+
+        @param seed Seed of the random generator.
+        """
+        self.random = random.Random(seed)
+        self.tags = [tag for tag, _ in TAGS]
+        self.tag_weights = [weight for _, weight in TAGS]
+        self.levels = [level for level, _ in LEVELS]
+        self.level_weights = [weight for _, weight in LEVELS]
+        self.processes = [(self.random.randrange(100, 32768),
+                           self.random.randrange(1, THREADS + 1))
+                          for _ in range(PROCESSES)]
+        self.millis = 0
+
+    def message(self):
+        """
+        @brief
+        @return Text of a message.
+        """
+        rand = self.random
+        if rand.random() < LONG_MESSAGE_RATIO:
+            template = LONG_MESSAGE * rand.randrange(2, 6)
+        else:
+            template = rand.choice(MESSAGES)
+        return template.format(n=rand.randrange(10000),
+                               n2=rand.randrange(100),
+                               n3=rand.randrange(1000),
+                               h=f"{rand.getrandbits(32):08x}")
+
+    def date(self):
+        """
+        @brief
+        @return Date of the next line, a few milliseconds after the previous
+                one, in the logcat format.
+        """
+        self.millis += self.random.randrange(0, 20)
+        seconds, millis = divmod(self.millis, 1000)
+        minutes, seconds = divmod(seconds, 60)
+        hours, minutes = divmod(minutes, 60)
+        days, hours = divmod(hours, 24)
+        return (f"01-{days % 28 + 1:02} {hours:02}:{minutes:02}:"
+                f"{seconds:02}.{millis:03}")
+
+    def adb_line(self, logcat_format):
+        """
+        @brief
+
+        @param logcat_format One of ADB_FORMATS.
+
+        @return Line of log in the format, newline included.
+        """
+        rand = self.random
+        if rand.random() < BANNER_RATIO:
+            return f"--------- beginning of {rand.choice(BUFFERS)}\n"
+
+        tag = rand.choices(self.tags, self.tag_weights)[0]
+        level = rand.choices(self.levels, self.level_weights)[0]
+        pid, threads = rand.choice(self.processes)
+        tid = pid + rand.randrange(threads)
+        msg = self.message()
+        if logcat_format == "brief":
+            return f"{level}/{tag}({pid:5}): {msg}\n"
+        if logcat_format == "tag":
+            return f"{level}/{tag}: {msg}\n"
+        if logcat_format == "thread":
+            return f"{level}({pid:5}:{tid:5}) {msg}\n"
+        if logcat_format == "time":
+            return f"{self.date()} {level}/{tag}({pid:5}): {msg}\n"
+        return f"{self.date()} {pid:5} {tid:5} {level} {tag:8}: {msg}\n"
+
+    def cortex_line(self):
+        """
+        @brief
+        @return Line of log of a cortex serial port, newline included.
+        """
+        rand = self.random
+        kind = rand.choices([kind for kind, _ in CORTEX_KINDS],
+                            [weight for _, weight in CORTEX_KINDS])[0]
+        tag = rand.choice(CORTEX_TAGS)
+        if kind == "tagged":
+            line = f"[{tag}] {self.message()}"
+        elif kind == "tagonly":
+            line = f"[{tag}]"
+        elif kind == "boot":
+            line = f"(@)boot_stage_{rand.randrange(10)} {rand.randrange(1000)}"
+        else:
+            line = self.message().replace("(", "[").replace(")", "]")
+        if rand.random() < CR_RATIO:
+            line = "\r" + line
+        return line + "\n"
+
+    def lines(self, logcat_format, count):
+        """
+        @brief
+
+        @param logcat_format One of ADB_FORMATS, or CORTEX_FORMAT.
+        @param count Number of lines.
+
+        @return Iterator on the lines.
+        """
+        for _ in range(count):
+            if logcat_format == CORTEX_FORMAT:
+                yield self.cortex_line()
+            else:
+                yield self.adb_line(logcat_format)
+
+
+def generate(path, logcat_format, count, seed):
+    """
+    @brief Write a synthetic log in a file.
+
+    @param path
+    @param logcat_format One of ADB_FORMATS, or CORTEX_FORMAT.
+    @param count Number of lines.
+    @param seed Seed of the generator.
+
+    @return Size of the file in bytes.
+    """
+    with open(path, "w") as log:
+        for line in LogGenerator(seed).lines(logcat_format, count):
+            log.write(line)
+    return os.path.getsize(path)
+
+
+def run_end_to_end(interpreter, script, options, path, repeats):
+    """
+    @brief Run a script on a log, its output going to /dev/null.
+
+    @param interpreter Python interpreter running the script.
+    @param script
+    @param options Options of the script, None being replaced by the path of
+                   the log (read from stdin otherwise).
+    @param path Log file.
+    @param repeats Number of runs.
+
+    @return Tuple of the best time of the runs, in seconds, and the stderr of
+            that run.
+
+    @exception RuntimeError The script failed, with its last error line.
+    """
+    from_file = None in options
+    arguments = [path if option is None else option for option in options]
+    best = None
+    for _ in range(repeats):
+        with open(path, "rb") as log, open(os.devnull, "wb") as devnull:
+            start = time.perf_counter()
+            result = subprocess.run(
+                [interpreter, script, *arguments],
+                stdin=subprocess.DEVNULL if from_file else log,
+                stdout=devnull, stderr=subprocess.PIPE)
+            elapsed = time.perf_counter() - start
+        errors = result.stderr.decode(errors="replace")
+        if result.returncode:
+            lines = errors.strip().splitlines() or [
+                f"exit status {result.returncode}"]
+            raise RuntimeError(lines[-1])
+        if best is None or elapsed < best[0]:
+            best = (elapsed, errors)
+    return best
+
+
+def profile_stages(report):
+    """
+    @brief
+
+    @param report --profile report printed by a script.
+
+    @return Dict of the time per call of each stage, in microseconds.
+    """
+    stages = {}
+    for line in report.splitlines():
+        match = reprofilestage.match(line)
+        if match is not None:
+            stages[match.group(1)] = float(match.group(4))
+    return stages
+
+
+def load_adb_logcat():
+    """
+    @brief
+    @return adb_logcat.py imported as a module.
+    """
+    spec = importlib.util.spec_from_file_location("adb_logcat", ADB_LOGCAT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_function(func, items, repeats):
+    """
+    @brief Call a function on each item, then once more while tracing the
+           allocations.
+
+    @param func
+    @param items
+    @param repeats Number of timed runs.
+
+    @return Tuple of the best time of the runs, in seconds, and the peak of
+            the memory allocated during a run, in bytes.
+    """
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for item in items:
+            func(item)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    for item in items:
+        func(item)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def function_benchmarks(adb_logcat, logs):
+    """
+    @brief
+
+    @param adb_logcat adb_logcat.py module.
+    @param logs Dict of the lines of each format.
+
+    @return List of the name, function and items of each benchmark of the
+            functions of adb_logcat.py.
+    """
+    benchmarks = []
+    for logcat_format in ADB_FORMATS:
+        lines = [line.rstrip("\n") for line in logs[logcat_format]]
+        parser = adb_logcat.LogcatParser(logcat_format)
+        benchmarks.append((f"parse {logcat_format}", parser.parse, lines))
+
+    lines = [line.rstrip("\n") for line in logs["threadtime"]]
+    parser = adb_logcat.LogcatParser("threadtime")
+    records = [record for record in map(parser.parse, lines)
+               if record is not None]
+    line_filter = adb_logcat.LineFilter(
+        re.compile("Manager"), min_level=adb_logcat.LEVEL_PRIORITY["I"])
+    benchmarks.append(("filter threadtime", line_filter.accept, records))
+    benchmarks.append(("render_record threadtime", adb_logcat.render_record,
+                       records))
+    benchmarks.append(("render_line threadtime",
+                       lambda line: adb_logcat.render_line(line, parser),
+                       lines))
+    return benchmarks
+
+
+def compare(results, baseline):
+    """
+    @brief
+
+    @param results Dict of the results of each benchmark.
+    @param baseline Dict of the results of each benchmark of a previous run.
+
+    @return List of the names of the benchmarks slower than the baseline.
+    """
+    return [name for name, result in results.items()
+            if name in baseline and result["lines/s"]
+            < baseline[name]["lines/s"] * REGRESSION_THRESHOLD]
+
+
+def usage():
+    """
+    @brief Print script usage.
+    """
+    print(
+        f"""
+        Measure the lines per second of adb_logcat.py and cortex_log.py on
+        synthetic logs, end to end and for the functions of the hot loop of
+        adb_logcat.py, with the peak of the memory they allocate. The logs
+        are generated from a seed, the same seed giving the same logs.
+
+            --help / -h  Print this help.
+            -n <lines>   Lines of each log (default {LINES}).
+            -r <runs>    Runs of each benchmark, the best one is kept
+                         (default {REPEATS}).
+            -s <seed>    Seed of the logs (default {SEED}).
+            -p           Run each script once more with --profile and show
+                         the time per call of its stages.
+            -k <regexp>  Only run the benchmarks which name matches the
+                         regular expression.
+            -g <format>  Write a log to stdout and exit, <format> being one
+                         of {', '.join(ADB_FORMATS)} or {CORTEX_FORMAT}.
+            --python2 <path>
+                         Interpreter of cortex_log.py (default python2).
+            --save <path>
+                         Write the results in a JSON file.
+            --baseline <path>
+                         Compare the results with the ones saved by a
+                         previous run: the exit status is 1 if a benchmark
+                         is below {REGRESSION_THRESHOLD:.0%} of its lines/s.
+        """
+    )
+    sys.exit(2)
+
+
+def main():
+    """
+    The script.
+    """
+    count = LINES
+    repeats = REPEATS
+    seed = SEED
+    selected = None
+    python2 = "python2"
+    save = None
+    baseline = None
+    profile = False
+    generated = None
+
+    try:
+        opts, _ = getopt.getopt(sys.argv[1:], "hn:r:s:k:g:p",
+                                ["help", "python2=", "save=", "baseline="])
+    except getopt.GetoptError as err:
+        print(err)
+        print("")
+        usage()
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            usage()
+        elif opt in ("-n", "-r", "-s"):
+            try:
+                value = int(arg)
+            except ValueError:
+                value = -1
+            if value < (0 if opt == "-s" else 1):
+                print("Bad number.\n")
+                usage()
+            if opt == "-n":
+                count = value
+            elif opt == "-r":
+                repeats = value
+            else:
+                seed = value
+        elif opt == "-p":
+            profile = True
+        elif opt == "-k":
+            selected = re.compile(arg)
+        elif opt == "-g":
+            if arg not in ADB_FORMATS and arg != CORTEX_FORMAT:
+                print("Bad format.\n")
+                usage()
+            generated = arg
+        elif opt == "--python2":
+            python2 = arg
+        elif opt == "--save":
+            save = arg
+        elif opt == "--baseline":
+            try:
+                with open(arg) as baseline_file:
+                    baseline = json.load(baseline_file)
+            except (OSError, ValueError) as err:
+                print(f"{err}\n")
+                usage()
+
+    if generated is not None:
+        # After all the options, -n and -s may follow -g
+        for line in LogGenerator(seed).lines(generated, count):
+            sys.stdout.write(line)
+        sys.exit(0)
+
+    results = {}
+    print(f"{'benchmark':<32} {'lines/s':>10} {'MB/s':>8} {'peak KiB':>9}"
+          + ("  stages (us/call)" if profile else ""))
+    with tempfile.TemporaryDirectory() as directory:
+        paths = {}
+        sizes = {}
+        for logcat_format in (*ADB_FORMATS, CORTEX_FORMAT):
+            paths[logcat_format] = os.path.join(directory,
+                                                f"{logcat_format}.log")
+            sizes[logcat_format] = generate(paths[logcat_format],
+                                            logcat_format, count, seed)
+
+        for name, script, logcat_format, options in END_TO_END:
+            if selected is not None and not selected.search(name):
+                continue
+            interpreter = python2 if script == CORTEX_LOG else sys.executable
+            try:
+                elapsed, _ = run_end_to_end(interpreter, script, options,
+                                            paths[logcat_format], repeats)
+                stages = {}
+                if profile:
+                    # Separate run, the profiling slows the script down
+                    _, errors = run_end_to_end(
+                        interpreter, script, [*options, "--profile"],
+                        paths[logcat_format], 1)
+                    stages = profile_stages(errors)
+            except (OSError, RuntimeError) as err:
+                print(f"{name:<32} failed: {err}")
+                continue
+            results[name] = {"lines/s": count / elapsed,
+                             "MB/s": sizes[logcat_format] / elapsed / 1e6}
+            if stages:
+                results[name]["stages"] = stages
+            print(f"{name:<32} {count / elapsed:>10.0f} "
+                  f"{sizes[logcat_format] / elapsed / 1e6:>8.2f} {'':>9}  "
+                  + " ".join(f"{stage} {micros:.2f}"
+                             for stage, micros in stages.items()))
+
+        logs = {}
+        for logcat_format in ADB_FORMATS:
+            with open(paths[logcat_format]) as log:
+                logs[logcat_format] = log.readlines()
+
+    # The rendering writes nothing, the functions only build the text
+    adb_logcat = load_adb_logcat()
+    for name, func, items in function_benchmarks(adb_logcat, logs):
+        if selected is not None and not selected.search(name):
+            continue
+        elapsed, peak = run_function(func, items, repeats)
+        results[name] = {"lines/s": len(items) / elapsed,
+                         "peak KiB": peak / 1024}
+        print(f"{name:<32} {len(items) / elapsed:>10.0f} {'':>8} "
+              f"{peak / 1024:>9.1f}")
+
+    if save is not None:
+        with open(save, "w") as save_file:
+            json.dump(results, save_file, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline)
+        for name in regressions:
+            print(f"Regression of {name}: {results[name]['lines/s']:.0f} "
+                  f"lines/s "
+                  f"against {baseline[name]['lines/s']:.0f}",
+                  file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()